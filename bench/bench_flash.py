@@ -0,0 +1,150 @@
+'''Flashing benchmarks against simulated boards, no hardware needed.
+
+The boards are bench/esp_sim.py instances running in a child process, so
+the CPU time reported is the flasher's own. Every scenario goes through
+the same code as the GUI and the command line (dfu_cache, dfu_core,
+FlashSession), and prints its wall time and host CPU time:
+
+    zip load (no cache)   dfu_project.load_project
+    zip load (cold)       FirmwareCache.load on an empty cache
+    zip load (cached)     FirmwareCache.load of a known zip
+    full flash            dfu_core.flash_images of every image
+    erase + flash         the same with a chip erase first, on one session
+    smart reflash         smart flash of what is already on the board
+    multi-port xN         full flash of N boards with ParallelFlasher
+
+Usage:
+    python bench/bench_flash.py [--boards 4] [--baud 921600] [--repeat 3] [--json]
+
+Nothing is written outside a temporary folder (used as the app data folder).
+'''
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+WORK_DIR = tempfile.mkdtemp(prefix='esp_bench_')
+# keep the cache, logs and profiles of the run away from the user's
+os.environ['APPDATA'] = WORK_DIR
+
+import dfu_core
+import dfu_cache
+import dfu_project
+
+
+def make_image(size, random_part):
+    '''size bytes, random_part of them incompressible, the rest erased flash'''
+    random_bytes = int(size * random_part)
+    return os.urandom(random_bytes) + b'\xff' * (size - random_bytes)
+
+
+def make_release(path, app_kb):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr('bootloader_bench.bin', make_image(26 * 1024, 0.7))
+        zip.writestr('partitions_bench.bin', make_image(3 * 1024, 0.1))
+        zip.writestr('firmware_bench.bin', make_image(app_kb * 1024, 0.6))
+        zip.writestr('spiffs_bench.bin', make_image(1472 * 1024, 0.05))
+    return path
+
+
+def start_boards(count, args):
+    cmd = [sys.executable, os.path.join(BENCH_DIR, 'esp_sim.py'), '--count', str(count),
+           '--baud-limit', str(args.baud_limit), '--write-ms', str(args.write_ms), '--erase-ms', str(args.erase_ms)]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    ports = process.stdout.readline().split()
+    return process, ports
+
+
+def measure(func, repeat, verbose):
+    '''Median wall and CPU seconds of repeat runs of func, which must return True'''
+    walls, cpus = [], []
+    for _ in range(repeat):
+        out = sys.stdout if verbose else io.StringIO()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(out):
+            ok = func()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+        if ok is False:
+            raise RuntimeError('scenario failed' + ('' if verbose else ':\n' + out.getvalue()[-2000:]))
+    return statistics.median(walls), statistics.median(cpus)
+
+
+def images_of(found):
+    return [(address, found[role]) for role, _, address in dfu_project.ROLES if role in found]
+
+
+def run(args):
+    zip_path = make_release(os.path.join(WORK_DIR, 'release.zip'), args.app_kb)
+    process, ports = start_boards(args.boards, args)
+    port = ports[0]
+    baud, chip = args.baud, 'esp32'
+
+    def flash(port, images, **options):
+        return dfu_core.flash_images(port, baud, chip, images, 'no_reset', 'no_reset', **options)
+
+    def load_cold():
+        shutil.rmtree(os.path.join(WORK_DIR, 'cache'), ignore_errors=True)
+        dfu_cache.FirmwareCache().load(zip_path)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        images = images_of(dfu_project.load_project(zip_path))
+    size = sum(len(image) for _, image in images)
+
+    scenarios = [
+        ('zip load (no cache)', lambda: dfu_project.load_project(zip_path)),
+        ('zip load (cold)', load_cold),
+        ('zip load (cached)', lambda: dfu_cache.FirmwareCache().load(zip_path)),
+        ('full flash', lambda: flash(port, images)),
+        ('erase + flash', lambda: flash(port, images, erase=True)),
+        ('smart reflash', lambda: flash(port, images, smart=True)),
+    ]
+    if len(ports) > 1:
+        scenarios.append(('multi-port x%d' % len(ports),
+                          lambda: all(dfu_core.ParallelFlasher(ports).run(lambda p: flash(p, images)))))
+
+    results = []
+    try:
+        for name, func in scenarios:
+            wall, cpu = measure(func, args.repeat, args.verbose)
+            results.append({'scenario': name, 'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3)})
+            if not args.json:
+                print('%-22s %8.2f s wall %8.2f s cpu' % (name, wall, cpu))
+    finally:
+        process.kill()
+
+    if args.json:
+        print(json.dumps({'baud': baud, 'boards': len(ports), 'image_bytes': size, 'results': results}, indent=1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the flasher against simulated ESP32 boards')
+    parser.add_argument('--boards', type=int, default=4, help='simulated boards for the multi-port run')
+    parser.add_argument('--baud', default='921600')
+    parser.add_argument('--baud-limit', type=int, default=2000000, help='fastest rate the simulated link accepts')
+    parser.add_argument('--write-ms', type=float, default=1.5, help='flash program time per 4 KB sector')
+    parser.add_argument('--erase-ms', type=float, default=2.0, help='flash erase time per 4 KB sector')
+    parser.add_argument('--app-kb', type=int, default=1024, help='size of the app image')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the median is reported')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help='show the flasher output')
+    args = parser.parse_args(argv)
+    try:
+        run(args)
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
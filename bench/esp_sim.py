@@ -0,0 +1,378 @@
+'''Software stand-in for an ESP32 ROM bootloader and flasher stub behind a pty.
+
+Speaks the SLIP framed serial protocol esptool uses: sync, register reads,
+RAM download of the stub, baud rate change, plain and compressed flash
+writes, region and chip erase, flash read and flash MD5. Link speed and
+flash timings are simulated with sleeps so that benchmarks measure the same
+order of magnitude as real hardware.
+
+Run it on its own (it prints the pty paths and serves until killed):
+    python bench/esp_sim.py --baud-limit 2000000 --flash-size 4MB --count 2
+or start it from Python with SimulatedEsp(...).start().
+
+A pty has no modem lines, so clients must use --before no_reset and
+--after no_reset (or soft_reset).
+'''
+import os
+import sys
+import tty
+import time
+import zlib
+import struct
+import hashlib
+import argparse
+import threading
+
+# command opcodes, see esptool/loader.py
+FLASH_BEGIN = 0x02
+FLASH_DATA = 0x03
+FLASH_END = 0x04
+MEM_BEGIN = 0x05
+MEM_END = 0x06
+MEM_DATA = 0x07
+SYNC = 0x08
+WRITE_REG = 0x09
+READ_REG = 0x0A
+SPI_SET_PARAMS = 0x0B
+SPI_ATTACH = 0x0D
+CHANGE_BAUDRATE = 0x0F
+FLASH_DEFL_BEGIN = 0x10
+FLASH_DEFL_DATA = 0x11
+FLASH_DEFL_END = 0x12
+SPI_FLASH_MD5 = 0x13
+GET_SECURITY_INFO = 0x14
+ERASE_FLASH = 0xD0
+ERASE_REGION = 0xD1
+READ_FLASH = 0xD2
+
+CHIP_DETECT_MAGIC_REG = 0x40001000
+ESP32_MAGIC = 0x00F01D83
+UART_CLKDIV_REG = 0x3FF40014
+SPI_W0_REG = 0x3FF42080
+
+SECTOR = 0x1000
+SIZES = {'1MB': 0x100000, '2MB': 0x200000, '4MB': 0x400000, '8MB': 0x800000, '16MB': 0x1000000}
+FLASH_ID = {0x100000: 0x1440EF, 0x200000: 0x1540EF, 0x400000: 0x1640EF, 0x800000: 0x1740EF, 0x1000000: 0x1840EF}
+
+# invalid command, as the ROM answers it
+ROM_INVALID = b'\x01\x05'
+
+
+def slip_encode(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+class SimulatedEsp:
+    '''One simulated ESP32 on one pty
+
+    baud_limit: fastest rate the simulated link accepts, faster rates
+        corrupt every reply so the host sees sync/checksum errors
+    flash_write_s_per_sector / erase_s_per_sector: flash timings
+    md5_s_per_mb: time the stub takes to hash flash
+    drop_replies: {opcode: [n, ...]} the n-th commands of opcode (counting
+        from 1) are carried out but their reply is lost, as on a bad link
+    '''
+    def __init__(self, flash_size='4MB', baud_limit=2000000, flash_write_s_per_sector=0.0015,
+                 erase_s_per_sector=0.002, md5_s_per_mb=0.015, simulate_link=True, flash=None, drop_replies=None):
+        self.size = SIZES[flash_size]
+        self.flash = bytearray(flash if flash is not None else b'\xff' * self.size)
+        self.baud_limit = baud_limit
+        self.write_s = flash_write_s_per_sector
+        self.erase_s = erase_s_per_sector
+        self.md5_s = md5_s_per_mb
+        self.simulate_link = simulate_link
+        self.drop_replies = drop_replies or {}
+        self.op_counts = {}
+        self.muted = False
+
+        self.baud = 115200
+        self.stub = False
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.thread = None
+        self.running = False
+        self.stats = {'rx_bytes': 0, 'tx_bytes': 0, 'commands': 0, 'sectors_written': 0, 'sectors_erased': 0}
+
+        self._write = None
+        self._inflate = None
+
+    ################################################################
+    #                          TRANSPORT                           #
+    ################################################################
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def reset(self):
+        '''What the reset line does on a real board: back to the ROM loader at its default rate'''
+        self.baud = 115200
+        self.stub = False
+
+    def link_delay(self, nbytes):
+        if self.simulate_link:
+            # 10 bits per byte on the wire
+            time.sleep(nbytes * 10.0 / self.baud)
+
+    def send(self, packet):
+        frame = slip_encode(packet)
+        self.link_delay(len(frame))
+        if self.baud > self.baud_limit:
+            # the adapter can't keep up: garbage on the line
+            frame = bytes((b ^ 0x5A) for b in frame)
+        self.stats['tx_bytes'] += len(frame)
+        os.write(self.master, frame)
+
+    def reply(self, op, value=0, data=b'', error=None):
+        if self.muted:
+            self.muted = False
+            return
+        if error is not None:
+            status = b'\x01' + bytes([error])
+        else:
+            status = b'\x00\x00'
+        if not self.stub:
+            status += b'\x00\x00'
+        payload = data + status
+        self.send(struct.pack('<BBHI', 1, op, len(payload), value) + payload)
+
+    def frames(self):
+        '''Yield decoded SLIP frames read from the pty'''
+        buf = bytearray()
+        inside = False
+        escaped = False
+        while self.running:
+            try:
+                chunk = os.read(self.master, 65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            self.stats['rx_bytes'] += len(chunk)
+            self.link_delay(len(chunk))
+            for b in chunk:
+                if not inside:
+                    if b == 0xC0:
+                        inside = True
+                        buf = bytearray()
+                    continue
+                if escaped:
+                    buf.append({0xDC: 0xC0, 0xDD: 0xDB}.get(b, b))
+                    escaped = False
+                elif b == 0xDB:
+                    escaped = True
+                elif b == 0xC0:
+                    if buf:
+                        yield bytes(buf)
+                        inside = False
+                    # an empty frame is two delimiters back to back, stay inside
+                else:
+                    buf.append(b)
+
+    def serve(self):
+        frames = self.frames()
+        for frame in frames:
+            if len(frame) < 8:
+                continue
+            direction, op, size, checksum = struct.unpack('<BBHI', frame[:8])
+            if direction != 0:
+                continue
+            self.stats['commands'] += 1
+            data = frame[8:8 + size]
+            if self.baud > self.baud_limit:
+                # commands arrive corrupted too, nothing sensible comes back
+                self.send(b'\x00' * 8)
+                continue
+            self.op_counts[op] = self.op_counts.get(op, 0) + 1
+            self.muted = self.op_counts[op] in self.drop_replies.get(op, ())
+            handler = self.HANDLERS.get(op)
+            if handler is None:
+                self.reply(op, error=0x05)
+                continue
+            handler(self, op, data, frames)
+
+    ################################################################
+    #                          COMMANDS                            #
+    ################################################################
+    def do_sync(self, op, data, frames):
+        # answered 8 times, with a non-zero value by the ROM and 0 by the stub
+        for _ in range(8):
+            self.reply(op, value=0 if self.stub else 0x20120707)
+
+    def do_read_reg(self, op, data, frames):
+        address, = struct.unpack('<I', data[:4])
+        value = {
+            CHIP_DETECT_MAGIC_REG: ESP32_MAGIC,
+            UART_CLKDIV_REG: 40000000 // 115200,
+            SPI_W0_REG: FLASH_ID.get(self.size, 0x1640EF),
+        }.get(address, 0)
+        self.reply(op, value=value)
+
+    def do_ack(self, op, data, frames):
+        self.reply(op)
+
+    def do_mem_end(self, op, data, frames):
+        self.reply(op)
+        # jumping to the stub entry point
+        self.stub = True
+        self.send(b'OHAI')
+
+    def do_change_baud(self, op, data, frames):
+        new_baud, _ = struct.unpack('<II', data[:8])
+        self.reply(op)
+        time.sleep(0.001)
+        self.baud = new_baud
+
+    def do_get_security_info(self, op, data, frames):
+        # ESP32 doesn't know this command
+        self.reply(op, error=0x05)
+
+    def erase(self, offset, size):
+        start = offset - offset % SECTOR
+        end = offset + size
+        end = end + (-end % SECTOR)
+        sectors = (end - start) // SECTOR
+        time.sleep(sectors * self.erase_s)
+        self.stats['sectors_erased'] += sectors
+        self.flash[start:end] = b'\xff' * (end - start)
+
+    def program(self, offset, chunk):
+        # NOR flash can only clear bits
+        current = int.from_bytes(self.flash[offset:offset + len(chunk)], 'little')
+        self.flash[offset:offset + len(chunk)] = (current & int.from_bytes(chunk, 'little')).to_bytes(len(chunk), 'little')
+        sectors = max(1, len(chunk) // SECTOR)
+        self.stats['sectors_written'] += sectors
+        time.sleep(sectors * self.write_s)
+
+    def do_flash_begin(self, op, data, frames):
+        size, blocks, blocksize, offset = struct.unpack('<IIII', data[:16])
+        if size:
+            self.erase(offset, size)
+        self._write = {'offset': offset, 'pos': offset}
+        self.reply(op)
+
+    def do_flash_data(self, op, data, frames):
+        length, seq, _, _ = struct.unpack('<IIII', data[:16])
+        block = data[16:16 + length]
+        self.reply(op)
+        self.program(self._write['pos'], block)
+        self._write['pos'] += len(block)
+
+    def do_flash_defl_begin(self, op, data, frames):
+        size, blocks, blocksize, offset = struct.unpack('<IIII', data[:16])
+        if size:
+            self.erase(offset, size)
+        self._write = {'offset': offset, 'pos': offset}
+        self._inflate = zlib.decompressobj()
+        self.reply(op)
+
+    def do_flash_defl_data(self, op, data, frames):
+        length, seq, _, _ = struct.unpack('<IIII', data[:16])
+        block = data[16:16 + length]
+        self.reply(op)
+        out = self._inflate.decompress(block)
+        self.program(self._write['pos'], out)
+        self._write['pos'] += len(out)
+
+    def do_erase_flash(self, op, data, frames):
+        self.erase(0, self.size)
+        self.reply(op)
+
+    def do_erase_region(self, op, data, frames):
+        offset, size = struct.unpack('<II', data[:8])
+        if offset % SECTOR or size % SECTOR:
+            self.reply(op, error=0x32)
+            return
+        self.erase(offset, size)
+        self.reply(op)
+
+    def do_md5(self, op, data, frames):
+        address, size, _, _ = struct.unpack('<IIII', data[:16])
+        time.sleep(size / 0x100000 * self.md5_s)
+        digest = hashlib.md5(self.flash[address:address + size]).digest()
+        if self.stub:
+            self.reply(op, data=digest)
+        else:
+            self.reply(op, data=digest.hex().encode())
+
+    def do_read_flash(self, op, data, frames):
+        offset, length, block_size, in_flight = struct.unpack('<IIII', data[:16])
+        self.reply(op)
+        sent = 0
+        acked = 0
+        while sent < length:
+            # keep at most in_flight blocks unacknowledged, like the stub
+            while sent < length and (sent - acked) // block_size < in_flight:
+                chunk = bytes(self.flash[offset + sent:offset + min(length, sent + block_size)])
+                self.send(chunk)
+                sent += len(chunk)
+            ack = next(frames, None)
+            if ack is None:
+                return
+            acked, = struct.unpack('<I', ack[:4])
+        while acked < length:
+            ack = next(frames, None)
+            if ack is None:
+                return
+            acked, = struct.unpack('<I', ack[:4])
+        self.send(hashlib.md5(self.flash[offset:offset + length]).digest())
+
+    HANDLERS = {
+        SYNC: do_sync,
+        READ_REG: do_read_reg,
+        WRITE_REG: do_ack,
+        SPI_SET_PARAMS: do_ack,
+        SPI_ATTACH: do_ack,
+        MEM_BEGIN: do_ack,
+        MEM_DATA: do_ack,
+        MEM_END: do_mem_end,
+        CHANGE_BAUDRATE: do_change_baud,
+        GET_SECURITY_INFO: do_get_security_info,
+        FLASH_BEGIN: do_flash_begin,
+        FLASH_DATA: do_flash_data,
+        FLASH_END: do_ack,
+        FLASH_DEFL_BEGIN: do_flash_defl_begin,
+        FLASH_DEFL_DATA: do_flash_defl_data,
+        FLASH_DEFL_END: do_ack,
+        SPI_FLASH_MD5: do_md5,
+        ERASE_FLASH: do_erase_flash,
+        ERASE_REGION: do_erase_region,
+        READ_FLASH: do_read_flash,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulated ESP32 ROM bootloader and flasher stub on a pty')
+    parser.add_argument('--flash-size', default='4MB', choices=sorted(SIZES))
+    parser.add_argument('--baud-limit', type=int, default=2000000)
+    parser.add_argument('--write-ms', type=float, default=1.5, help='flash program time per 4 KB sector')
+    parser.add_argument('--erase-ms', type=float, default=2.0, help='flash erase time per 4 KB sector')
+    parser.add_argument('--no-link-delay', action='store_true', help="don't simulate the serial link speed")
+    parser.add_argument('--count', type=int, default=1, help='number of boards, their ptys are printed on one line')
+    args = parser.parse_args(argv)
+
+    sims = [SimulatedEsp(args.flash_size, args.baud_limit, args.write_ms / 1000.0, args.erase_ms / 1000.0,
+                         simulate_link=not args.no_link_delay).start() for _ in range(args.count)]
+    print(' '.join(sim.port for sim in sims))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for sim in sims:
+            sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''Automatic baud rate selection, remembered per USB serial adapter. No wx here.
+
+In auto mode a session starts at the best rate known for the adapter (the
+fastest one for an unknown adapter), checks the link with a flash read and
+steps down a rate on every sync, checksum or timeout error. The rate that
+works is saved under the adapter's VID:PID and serial number, so the same
+cable starts at its known good rate on the next run, whatever port name
+it gets.
+'''
+import os
+import json
+import time
+import threading
+import dfu_ports
+
+AUTO = 'auto'
+
+# tried fastest first
+RATES = [2000000, 1500000, 921600, 460800, 230400, 115200]
+
+
+def slower(rate):
+    '''The next rate to try after rate failed, or None'''
+    lower = [candidate for candidate in RATES if candidate < rate]
+    return lower[0] if lower else None
+
+
+class BaudProfiles:
+    '''Known good rate of every adapter, kept in a JSON file'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.profiles = json.load(file)
+        except (OSError, ValueError):
+            self.profiles = {}
+
+    def start_rate(self, port):
+        with self.lock:
+            profile = self.profiles.get(dfu_ports.adapter_key(port))
+        return profile['baud'] if profile else RATES[0]
+
+    def record(self, port, rate, ok):
+        '''Remember that rate worked on port, or that the next slower one should be used'''
+        rate = rate if ok else slower(rate)
+        if rate is None:
+            return
+        with self.lock:
+            key = dfu_ports.adapter_key(port)
+            profile = self.profiles.setdefault(key, {'baud': rate, 'failures': 0})
+            profile['baud'] = rate
+            profile['updated'] = time.time()
+            if not ok:
+                profile['failures'] += 1
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as file:
+                json.dump(self.profiles, file, indent=1)
+            os.replace(tmp, self.path)
+        if not ok:
+            print('%s: falling back to %d baud' % (key, rate))
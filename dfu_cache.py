@@ -0,0 +1,226 @@
+'''Persistent, content-addressed cache of the images of release zips. No wx here.
+
+Every zip is keyed by the SHA-256 of its bytes. An entry holds the images
+extracted from it, their digests, and any preprocessed artifact stored
+next to them (compressed payloads, parsed headers...). Entries are evicted
+least recently used first once the cache grows past max_bytes.
+
+Layout:
+    <root>/index.json               LRU bookkeeping and zip stat memo
+    <root>/<digest>/manifest.json   role -> name, size, digests
+    <root>/<digest>/<role>.bin      the image itself
+    <root>/<digest>/<artifact>      anything saved with save_artifact()
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import dfu_core
+import dfu_header
+import dfu_project
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+DIGESTS = dfu_project.DIGESTS
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+
+
+class FirmwareCache:
+    '''On-disk image cache, see the module docstring for the layout'''
+    def __init__(self, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root or os.path.join(dfu_core.app_data_dir(), 'cache')
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self._read_index()
+
+    ################################################################
+    #                         BOOKKEEPING                          #
+    ################################################################
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.root, 'index.json')) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('entries', {})
+        index.setdefault('stat', {})
+        # drop entries whose directory went away
+        for digest in list(index['entries']):
+            if not os.path.isfile(os.path.join(self.root, digest, 'manifest.json')):
+                del index['entries'][digest]
+        return index
+
+    def _write_index(self):
+        write_atomic(os.path.join(self.root, 'index.json'), json.dumps(self.index).encode())
+
+    def _touch(self, digest):
+        self.index['entries'][digest]['last_used'] = time.time()
+
+    def _entry_size(self, digest):
+        path = os.path.join(self.root, digest)
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.index['entries'].values())
+
+    def evict(self, keep=None):
+        '''Remove least recently used entries until the cache fits in max_bytes'''
+        with self.lock:
+            entries = sorted(self.index['entries'].items(), key=lambda item: item[1]['last_used'])
+            total = self.total_bytes()
+            for digest, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                if digest == keep:
+                    continue
+                shutil.rmtree(os.path.join(self.root, digest), ignore_errors=True)
+                del self.index['entries'][digest]
+                total -= entry['size']
+                print('cache: evicted ' + digest[:12])
+            # forget the stat memo of zips that are no longer cached
+            self.index['stat'] = {path: memo for path, memo in self.index['stat'].items() if memo[2] in self.index['entries']}
+            self._write_index()
+
+    ################################################################
+    #                           LOOKUP                             #
+    ################################################################
+    def zip_digest(self, zip_path):
+        '''SHA-256 of a zip, memoized on its path, size and modification time'''
+        st = os.stat(zip_path)
+        key = os.path.abspath(zip_path)
+        with self.lock:
+            memo = self.index['stat'].get(key)
+            if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+                return memo[2]
+        digest = file_digest(zip_path)
+        with self.lock:
+            self.index['stat'][key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def manifest(self, digest):
+        with self.lock:
+            if digest not in self.index['entries']:
+                return None
+        try:
+            with open(os.path.join(self.root, digest, 'manifest.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, zip_path):
+        '''{role: FirmwareImage} of a zip, from the cache when it is known'''
+        digest = self.zip_digest(zip_path)
+        manifest = self.manifest(digest)
+        if manifest is not None:
+            print('Project found in cache (' + digest[:12] + ')')
+            images = {}
+            for role, info in manifest['images'].items():
+                with open(os.path.join(self.root, digest, role + '.bin'), 'rb') as file:
+                    image = dfu_project.FirmwareImage(role, info['name'], file.read())
+                image.digests.update(info['digests'])
+                image.cache_key = (digest, role)
+                images[role] = image
+            with self.lock:
+                self._touch(digest)
+                self._write_index()
+            return images
+
+        images = dfu_project.load_project(zip_path)
+        self.store(digest, images)
+        return images
+
+    def store(self, digest, images):
+        '''Add the images of a zip to the cache under its digest'''
+        tmp = os.path.join(self.root, digest + '.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        manifest = {'images': {}}
+        dfu_project.hash_images(images.values(), DIGESTS)
+        for role, image in images.items():
+            with open(os.path.join(tmp, role + '.bin'), 'wb') as file:
+                file.write(image.data)
+            manifest['images'][role] = {
+                'name': image.name,
+                'size': len(image),
+                'digests': {name: image.digest(name) for name in DIGESTS},
+            }
+            image.cache_key = (digest, role)
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file)
+
+        with self.lock:
+            final = os.path.join(self.root, digest)
+            shutil.rmtree(final, ignore_errors=True)
+            os.replace(tmp, final)
+            self.index['entries'][digest] = {'size': self._entry_size(digest), 'last_used': time.time()}
+        self.evict(keep=digest)
+
+    ################################################################
+    #                          ARTIFACTS                           #
+    ################################################################
+    def artifact_path(self, image, artifact):
+        '''Where a preprocessed form of a cached image lives, or None if it isn't cached'''
+        if image.cache_key is None:
+            return None
+        digest, role = image.cache_key
+        return os.path.join(self.root, digest, role + '.' + artifact)
+
+    def load_artifact(self, image, artifact):
+        path = self.artifact_path(image, artifact)
+        if path is None or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def precompress(self, images):
+        '''Compress every image for flashing, reusing the stream saved in the cache if any'''
+        for image in images:
+            data = self.load_artifact(image, 'deflate')
+            if data is not None:
+                with image.lock:
+                    image.compressed = data
+            else:
+                self.save_artifact(image, 'deflate', image.deflated())
+
+    def headers(self, images):
+        '''Parse the ESP image header of the bootloader and app images, reusing the one saved in the cache if any
+
+        Raises ValueError for a corrupt image; nothing is saved for it then.
+        '''
+        for image in images:
+            if image.role not in dfu_header.HEADER_ROLES or image.header is not None:
+                continue
+            data = self.load_artifact(image, 'header')
+            if data is not None:
+                image.header = dfu_header.ImageHeader.from_dict(json.loads(data))
+            else:
+                self.save_artifact(image, 'header', json.dumps(dfu_header.header_of(image).as_dict()).encode())
+
+    def save_artifact(self, image, artifact, data):
+        path = self.artifact_path(image, artifact)
+        if path is None or not os.path.isdir(os.path.dirname(path)):
+            return
+        write_atomic(path, data)
+        digest = image.cache_key[0]
+        with self.lock:
+            if digest in self.index['entries']:
+                self.index['entries'][digest]['size'] = self._entry_size(digest)
+                self._write_index()
@@ -0,0 +1,271 @@
+'''Headless entry point of the ESP Flasher, for line PCs and CI rigs.
+
+Never imports wx. esptool chatter goes to stderr so stdout only carries
+the results, one line per job (JSON with --json).
+
+Exit status: 0 if every job succeeded, 1 if any job failed, 2 on bad arguments.
+
+Examples:
+    python dfu_cli.py --zip release.zip --port COM3 COM4 COM5
+    python dfu_cli.py --app firmware.bin --port /dev/ttyUSB0 --baud 460800 --json
+    python dfu_cli.py --batch jobs.txt --json
+    python dfu_cli.py --read 0x0 0x400000 dump.bin --port COM3
+    python dfu_cli.py --zip release.zip --read-partitions dumps/ --port COM3
+    python dfu_cli.py --stats 8
+'''
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import zipfile
+import dfu_core
+import dfu_baud
+import dfu_project
+import dfu_cache
+import dfu_header
+import dfu_metrics
+import dfu_monitor
+import dfu_stats
+import dfu_partitions
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='dfu_cli', description='ESP Flasher Programming Tool (headless)')
+    parser.add_argument('--zip', nargs='+', default=[], help='release zip(s), every zip is flashed on every port')
+    for role, pattern, address in dfu_project.ROLES:
+        parser.add_argument('--' + role, metavar='BIN', help='%s image (%s in a zip)' % (role, pattern))
+        parser.add_argument('--' + role + '-addr', metavar='ADDR',
+                            help='%s address (default: from the partition table, else %s)' % (role, address))
+    parser.add_argument('--port', nargs='+', default=[], help='serial port(s), flashed in parallel')
+    parser.add_argument('--batch', metavar='FILE', help='text file with one "PORT ZIP" job per line')
+    parser.add_argument('--baud', default='921600', help="baud rate, or 'auto' to use the fastest rate that works on each adapter")
+    parser.add_argument('--chip', help='default: the chip the bootloader and app are built for, else esp32')
+    parser.add_argument('--before', default='default_reset', choices=['default_reset', 'no_reset'])
+    parser.add_argument('--after', default='hard_reset', choices=['hard_reset', 'no_reset'])
+    parser.add_argument('--smart', action='store_true', help='only write the sectors whose content differs on the device')
+    parser.add_argument('--verify', action='store_true', help='check the flash MD5 of every image again once all are written')
+    parser.add_argument('--erase', action='store_true', help='erase the whole flash before writing (or only erase if no image is given)')
+    parser.add_argument('--erase-regions', nargs='*', metavar='PARTITION',
+                        help='erase only what the images will cover, plus the partitions named here (nvs, otadata...)')
+    parser.add_argument('--monitor', action='store_true',
+                        help='watch the board boot after its flash, the log goes to the monitor folder of the app data')
+    parser.add_argument('--monitor-baud', type=int, default=dfu_monitor.MONITOR_BAUD)
+    parser.add_argument('--monitor-seconds', type=float, default=dfu_monitor.DURATION_S,
+                        help='how long to watch, unless a pattern matches first')
+    parser.add_argument('--pass-pattern', metavar='REGEX', help='a line matching it ends the monitor, the job passed')
+    parser.add_argument('--fail-pattern', metavar='REGEX', help='a line matching it ends the monitor, the job failed')
+    parser.add_argument('--read', nargs=3, action='append', metavar=('ADDR', 'SIZE', 'FILE'),
+                        help='stream a flash range to FILE instead of flashing (repeatable)')
+    parser.add_argument('--read-partitions', metavar='DIR',
+                        help='dump every partition of the partition table (--partitions or --zip) to DIR instead of flashing')
+    parser.add_argument('--stats', nargs='?', type=float, const=dfu_stats.REPORT_HOURS, metavar='HOURS',
+                        help='print the production statistics of the last HOURS (default %g) and exit' % dfu_stats.REPORT_HOURS)
+    parser.add_argument('--no-cache', action='store_true', help="don't use the on-disk firmware cache")
+    parser.add_argument('--json', action='store_true', help='print one JSON object per job on stdout')
+    args = parser.parse_args(argv)
+
+    if not args.port and not args.batch and args.stats is None:
+        parser.error('give at least one --port or a --batch file')
+    if args.baud == dfu_baud.AUTO and args.before == 'no_reset':
+        parser.error("--baud auto steps down from the ROM rate after a failed probe, which needs --before default_reset")
+    for pattern in (args.pass_pattern, args.fail_pattern):
+        try:
+            re.compile(pattern or '')
+        except re.error as e:
+            parser.error('bad pattern %r: %s' % (pattern, e))
+    return args
+
+
+class Job:
+    '''One source (zip or set of bin files) to run on one port'''
+    def __init__(self, port, source, images, erase=False, chip='esp32', reads=()):
+        self.port = port
+        self.source = source
+        self.images = images
+        self.chip = chip
+        # [(address, size, path)] of flash read to files instead of flashing
+        self.reads = reads
+        # True for a chip erase or [(offset, size)] regions, see dfu_core.flash_images()
+        self.erase = erase
+        self.ok = False
+        # result of the monitor run after the flash, see dfu_monitor
+        self.self_test = None
+        self.seconds = 0.0
+        # made by run_job() when the job starts, so the wait behind other jobs is not timed
+        self.record = None
+
+    def result(self):
+        record = self.record or dfu_metrics.JobRecord(self.port)
+        return {'port': self.port, 'source': self.source, 'ok': self.ok, 'seconds': round(self.seconds, 3),
+                'mac': record.mac, 'verified': record.verified, 'self_test': self.self_test,
+                'stages': record.stages}
+
+
+def plan(args, found):
+    '''[(address, FirmwareImage)], erase and chip of {role: FirmwareImage}, checked before any serial traffic
+
+    Addresses given on the command line win, then the ones of the partition
+    table among the images (and the bootloader address of the chip the
+    images are built for), then the defaults. The chip comes from the
+    image headers unless given, so it is not detected at connection.
+    '''
+    partitions = dfu_partitions.parse_partitions(found['partitions'].data) if 'partitions' in found else None
+    derived = dfu_partitions.role_addresses(partitions) if partitions else {}
+    built_for = dfu_header.project_chip([(None, image) for image in found.values()])
+    if built_for is not None:
+        derived['bootloader'] = dfu_header.bootloader_address(built_for)
+    chip = args.chip or built_for or 'esp32'
+    images = [(getattr(args, role + '_addr') or derived.get(role, address), found[role])
+              for role, _, address in dfu_project.ROLES if role in found]
+    dfu_partitions.check_images(images, partitions)
+    dfu_header.check_images(images, chip)
+
+    erase = args.erase
+    if args.erase_regions is not None:
+        erase = dfu_partitions.erase_plan(images, partitions, args.erase_regions)
+    return images, erase, chip
+
+
+def read_jobs(args):
+    '''Jobs streaming flash to files, with the name of the port in them when there are several ports'''
+    regions = [(int(address, 0), int(size, 0), path) for address, size, path in args.read or ()]
+    if args.read_partitions:
+        if args.partitions:
+            table = dfu_project.FirmwareImage.from_file('partitions', args.partitions)
+        elif args.zip:
+            table = dfu_project.ProjectIndex(args.zip[0]).load(['partitions']).get('partitions')
+        else:
+            table = None
+        if table is None:
+            raise ValueError('--read-partitions needs a partition table (--partitions or --zip)')
+        os.makedirs(args.read_partitions, exist_ok=True)
+        regions += dfu_partitions.dump_regions(dfu_partitions.parse_partitions(table.data), args.read_partitions)
+
+    jobs = []
+    for port in args.port:
+        reads = [(address, size, dfu_core.port_path(path, port) if len(args.port) > 1 else path)
+                 for address, size, path in regions]
+        jobs.append(Job(port, ' '.join(path for _, _, path in reads), [], False, args.chip or 'esp32', reads))
+    return jobs
+
+
+def build_jobs(args):
+    '''Turn the arguments into jobs, loading every zip only once per batch'''
+    if args.read or args.read_partitions:
+        return read_jobs(args)
+    sources = {}
+    cache = None if args.no_cache else dfu_cache.FirmwareCache()
+
+    def plan_of(zip_path):
+        if zip_path not in sources:
+            found = cache.load(zip_path) if cache else dfu_project.load_project(zip_path)
+            if cache:
+                cache.headers(found.values())
+                cache.precompress(found.values())
+            sources[zip_path] = plan(args, found)
+        return sources[zip_path]
+
+    jobs = []
+    for zip_path in args.zip:
+        jobs += [Job(port, zip_path, *plan_of(zip_path)) for port in args.port]
+
+    loose = {role: dfu_project.FirmwareImage.from_file(role, getattr(args, role))
+             for role, _, _ in dfu_project.ROLES if getattr(args, role)}
+    dfu_project.hash_images(loose.values())
+    if loose or (args.erase and not args.zip):
+        images, erase, chip = plan(args, loose)
+        jobs += [Job(port, ' '.join(image.name for _, image in images) or '-', images, erase, chip) for port in args.port]
+
+    if args.batch:
+        with open(args.batch) as batch:
+            for line in batch:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                port, zip_path = line.split(None, 1)
+                jobs.append(Job(port, zip_path, *plan_of(zip_path)))
+    return jobs
+
+
+def run_job(job, args):
+    start = time.time()
+    job.record = dfu_metrics.JobRecord(job.port, args.baud)
+    if job.reads:
+        ok = dfu_core.dump_flash(job.port, args.baud, job.chip, job.reads, args.before, args.after, job.record)
+    else:
+        monitor = None
+        if args.monitor:
+            monitor = {'baud': args.monitor_baud, 'duration': args.monitor_seconds,
+                       'pass_pattern': args.pass_pattern, 'fail_pattern': args.fail_pattern}
+        ok = dfu_core.flash_images(job.port, args.baud, job.chip, job.images, args.before, args.after, args.smart, job.erase,
+                                   job.record, args.verify, monitor)
+        job.self_test = job.record.self_test
+    job.ok = ok
+    job.seconds = time.time() - start
+    return ok
+
+
+def echo(worker, line):
+    '''Mirror every port's log on stderr, prefixed by its port'''
+    if line and not dfu_core.PROGRESS_RE.search(line):
+        sys.stderr.write('[' + worker.port + '] ' + line + '\n')
+
+
+def main(argv=None):
+    try:
+        args = parse_args(argv)
+    except SystemExit as e:
+        return e.code
+
+    if args.stats is not None:
+        for line in dfu_stats.format_report(dfu_core.stats().report(args.stats)):
+            print(line)
+        return EXIT_OK
+
+    # keep stdout for results only
+    results_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    try:
+        try:
+            jobs = build_jobs(args)
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            print('--- ERROR ---')
+            print(e)
+            return EXIT_USAGE
+        if not jobs:
+            print('nothing to do !')
+            return EXIT_USAGE
+
+        # one worker per port, jobs on the same port run one after another
+        by_port = {}
+        for job in jobs:
+            by_port.setdefault(job.port, []).append(job)
+
+        def work(port):
+            return all([run_job(job, args) for job in by_port[port]])
+
+        flasher = dfu_core.ParallelFlasher(list(by_port), echo)
+        flasher.run(work)
+        dfu_core.stats().flush()
+    finally:
+        sys.stdout = results_out
+
+    for job in jobs:
+        if args.json:
+            results_out.write(json.dumps(job.result()) + '\n')
+        else:
+            results_out.write('%-14s %-6s %7.1fs  %s\n' % (job.port, 'OK' if job.ok else 'FAILED', job.seconds, job.source))
+    results_out.flush()
+
+    return EXIT_OK if all(job.ok for job in jobs) else EXIT_FAILED
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+'''Bounded, coalescing console buffer sitting between stdout and the console widget.
+
+Writers (esptool, worker threads) only touch the buffer. The UI polls
+take_update() on a timer and applies one batched edit to the widget, so
+the UI thread sees at most one update per tick whatever the write rate.
+No wx here.
+'''
+import os
+import re
+import threading
+from collections import deque
+
+DEFAULT_MAX_LINES = 5000
+LOG_MAX_BYTES = 20 * 1024 * 1024
+
+CONTROL_RE = re.compile(r'([\r\n\b])')
+
+
+class ConsoleBuffer:
+    '''Ring buffer of console lines, editing the last line in place.
+
+    A carriage return makes the next text replace the current line, and
+    backspaces erase from it just before the next text arrives (the way
+    esptool draws its progress), so progress output never grows the buffer.
+    At most max_lines complete lines are kept; every complete line is also
+    appended to log_path when given.
+    '''
+    def __init__(self, max_lines=DEFAULT_MAX_LINES, log_path=None):
+        self.max_lines = max_lines
+        self.lines = deque()
+        self.current = ''
+        self.lock = threading.Lock()
+
+        self.carriage_return = False
+        self.backspaces = 0
+
+        # what changed since the widget was last updated
+        self.pending = 0
+        self.dropped = 0
+        self.shown_tail = ''
+
+        self.log = None
+        if log_path:
+            if os.path.exists(log_path) and os.path.getsize(log_path) > LOG_MAX_BYTES:
+                os.replace(log_path, log_path + '.1')
+            self.log = open(log_path, 'a', encoding='utf-8', errors='replace')
+
+    def write(self, string):
+        with self.lock:
+            for piece in CONTROL_RE.split(string):
+                if piece == '\n':
+                    self._commit()
+                elif piece == '\r':
+                    self.carriage_return = True
+                elif piece == '\b':
+                    self.backspaces += 1
+                elif piece:
+                    self._edit(piece)
+
+    def _edit(self, text):
+        if self.carriage_return:
+            self.current = ''
+            self.carriage_return = False
+        if self.backspaces:
+            self.current = self.current[:-self.backspaces]
+            self.backspaces = 0
+        self.current += text
+
+    def _commit(self):
+        line = self.current
+        self.current = ''
+        self.carriage_return = False
+        self.backspaces = 0
+
+        self.lines.append(line)
+        self.pending += 1
+        if self.log is not None:
+            self.log.write(line + '\n')
+
+        if len(self.lines) > self.max_lines:
+            self.lines.popleft()
+            if self.pending > len(self.lines):
+                # evicted before it was ever shown
+                self.pending -= 1
+            else:
+                self.dropped += 1
+
+    def take_update(self):
+        '''Return (lines to drop from the top, rewrite last line?, text to append) or None
+
+        To apply it: remove the first `drop` lines of the widget, remove its
+        last (unfinished) line if asked to, then append the text.
+        '''
+        with self.lock:
+            if self.log is not None:
+                self.log.flush()
+            if not self.pending and not self.dropped and self.current == self.shown_tail:
+                return None
+
+            new_lines = [self.lines[i] for i in range(len(self.lines) - self.pending, len(self.lines))]
+            text = ''.join(line + '\n' for line in new_lines) + self.current
+            update = (self.dropped, self.shown_tail != '', text)
+
+            self.pending = 0
+            self.dropped = 0
+            self.shown_tail = self.current
+            return update
+
+    def text(self):
+        '''Whole buffer content, for copying out of the console'''
+        with self.lock:
+            return ''.join(line + '\n' for line in self.lines) + self.current
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
@@ -0,0 +1,327 @@
+'''Flashing core shared by the GUI and the multi-port station mode.
+
+Nothing in here touches wx, so it can be driven from worker threads.
+esptool, pyserial and dfu_device are only imported by the functions that
+talk to a board, so the GUI can show its window before they load.
+'''
+import sys
+import os
+import re
+import threading
+import dfu_baud
+import dfu_ports
+import dfu_metrics
+from concurrent.futures import ThreadPoolExecutor
+
+# esptool prints its progress as "Writing at 0x00010000... (42 %)"
+PROGRESS_RE = re.compile(r'\((\d+) %\)')
+# and a flash read (dfu_device.read_to_file) its throughput on the same line
+RATE_RE = re.compile(r'([\d.]+) kbit/s')
+
+
+def app_data_dir():
+    '''Per-user directory for logs, caches and settings, created on demand'''
+    if os.environ.get('APPDATA'):
+        path = os.path.join(os.environ['APPDATA'], 'ESP_Flasher')
+    else:
+        path = os.path.join(os.path.expanduser('~'), '.esp_flasher')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# taken to make the shared objects below, which parallel workers may all ask for at once
+_shared_lock = threading.Lock()
+_baud_profiles = None
+
+
+def baud_profiles():
+    '''The per-adapter rates learnt in auto baud mode, shared by the whole process'''
+    global _baud_profiles
+    with _shared_lock:
+        if _baud_profiles is None:
+            _baud_profiles = dfu_baud.BaudProfiles(os.path.join(app_data_dir(), 'baud_profiles.json'))
+        return _baud_profiles
+
+
+_port_cache = None
+
+
+def port_cache():
+    '''The chip last found behind every adapter, shared by the whole process'''
+    global _port_cache
+    with _shared_lock:
+        if _port_cache is None:
+            _port_cache = dfu_ports.PortChipCache(os.path.join(app_data_dir(), 'ports.json'))
+        return _port_cache
+
+
+def detect_port(chip, exclude=()):
+    '''Port of a board matching chip, not one of exclude, see dfu_ports.detect()'''
+    import esptool
+    port = dfu_ports.detect(chip, port_cache(), exclude=exclude)
+    if port is None:
+        raise esptool.FatalError('No %s found on any serial port' % ('ESP' if chip == 'auto' else chip))
+    return port
+
+
+_checkpoints = None
+
+
+def checkpoints():
+    '''Write progress of every board, so retrying a failed job resumes its write'''
+    global _checkpoints
+    import dfu_device
+    with _shared_lock:
+        if _checkpoints is None:
+            _checkpoints = dfu_device.Checkpoints()
+        return _checkpoints
+
+
+_metrics_log = None
+_stats = None
+
+
+def metrics_log():
+    '''The rolling log every finished job is appended to (jobs.jsonl in the app data folder)'''
+    global _metrics_log
+    with _shared_lock:
+        if _metrics_log is None:
+            _metrics_log = dfu_metrics.MetricsLog(os.path.join(app_data_dir(), 'jobs.jsonl'))
+        return _metrics_log
+
+
+def stats():
+    '''dfu_stats.StatsStore of the app, started (and sqlite3 imported) by the first job'''
+    global _stats
+    import dfu_stats
+    with _shared_lock:
+        if _stats is None:
+            _stats = dfu_stats.StatsStore(os.path.join(app_data_dir(), 'stats.sqlite'), os.path.join(app_data_dir(), 'jobs.jsonl'))
+        return _stats
+
+
+def record_job(job, ok):
+    '''Finish a JobRecord, print its stage timings and append it to the job log and the stats'''
+    job.finish(ok)
+    print('Stage timings: ' + job.summary())
+    if job.port is not None and job.adapter is None:
+        job.adapter = dfu_ports.adapter_id(job.port)
+    stats().add(job)
+    try:
+        metrics_log().append(job)
+    except OSError as e:
+        print('could not write the job log: ' + str(e))
+    return ok
+
+
+class ThreadRoutedStream:
+    '''Stand-in for sys.stdout that sends each thread's output to its own sink.
+
+    esptool only knows how to print, so when several boards are flashed at
+    the same time every worker thread registers its own sink with route().
+    Threads without a route fall through to the original stream.
+    '''
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def route(self, sink):
+        self.local.sink = sink
+
+    def unroute(self):
+        self.local.sink = None
+
+    def current(self):
+        return getattr(self.local, 'sink', None) or self.default
+
+    def write(self, string):
+        return self.current().write(string)
+
+    def flush(self):
+        self.current().flush()
+
+    def isatty(self):
+        return False
+
+
+def install_routed_stdout():
+    '''Wrap sys.stdout in a ThreadRoutedStream (once) and return it'''
+    if not isinstance(sys.stdout, ThreadRoutedStream):
+        sys.stdout = ThreadRoutedStream(sys.stdout)
+    return sys.stdout
+
+
+def run_guarded(func, *args):
+    '''Run an esptool operation and report the outcome the way the GUI always has.
+
+    Returns True on success. Errors are printed, never raised, so one
+    failing board can't take the caller down with it.
+    '''
+    import serial
+    import esptool
+    try:
+        func(*args)
+        return True
+    except esptool.FatalError as e:
+        print('')
+        print('--- ERROR ---')
+        print(e)
+    except serial.SerialException as e:
+        print('--- ERROR ---')
+        print(e)
+    except Exception as e:
+        print('--- ERROR ---')
+        print(e)
+        print('unexpected error, maybe you chose invalid files, or files which overlap')
+    return False
+
+
+def flash_images(port, baud, chip, images, before='default_reset', after='hard_reset', smart=False, erase=False, job=None,
+                 verify=False, monitor=None):
+    '''Connect, optionally erase, write [(address, FirmwareImage)] and reset. Returns True on success
+
+    erase is True for the whole chip, or [(offset, size)] regions to erase.
+    With verify, the flash MD5 of every image is checked again once all of
+    them are written, before the reset. With monitor (dfu_monitor.SerialMonitor
+    keywords) the board is then watched booting, see dfu_monitor.self_test().
+
+    Everything runs on one FlashSession, so the board is synced and the stub
+    loaded only once. With smart, only the sectors whose content differs on
+    the device are written. A baud of 'auto' uses the rate learnt for the adapter.
+    The stages are timed in job (a new JobRecord by default), which ends up
+    in the job log.
+    '''
+    import dfu_device
+    job = job or dfu_metrics.JobRecord(port, baud)
+
+    def flash():
+        with dfu_device.FlashSession(port or detect_port(chip), baud, chip, before, baud_profiles(), job,
+                                     checkpoints()) as session:
+            if erase is True:
+                session.erase_flash()
+            elif erase:
+                session.erase_regions(erase)
+            if images:
+                session.write(images, smart)
+                if verify:
+                    session.verify(images)
+            session.reset(after)
+        if monitor:
+            import dfu_monitor
+            dfu_monitor.self_test(session.port, job.mac or session.port, monitor, job)
+
+    return record_job(job, run_guarded(flash))
+
+
+def port_path(path, port):
+    '''path with the name of port added before its extension, for one file per board'''
+    root, ext = os.path.splitext(path)
+    return '%s_%s%s' % (root, re.sub(r'[^\w.-]', '_', os.path.basename(port or 'auto')), ext)
+
+
+def dump_flash(port, baud, chip, regions, before='default_reset', after='hard_reset', job=None):
+    '''Connect, stream every [(address, size, path)] of flash to its file and reset. Returns True on success
+
+    A dump cut short is resumed by the next one of the same range and board.
+    '''
+    import dfu_device
+    job = job or dfu_metrics.JobRecord(port, baud)
+
+    def dump():
+        with dfu_device.FlashSession(port or detect_port(chip), baud, chip, before, baud_profiles(), job,
+                                     checkpoints()) as session:
+            session.dump(regions)
+            session.reset(after)
+
+    return record_job(job, run_guarded(dump))
+
+
+class PortWorker:
+    '''Status, progress and private log of one port in a parallel run'''
+
+    WAITING = 'waiting'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, port, on_update=None):
+        self.port = port
+        self.status = self.WAITING
+        self.progress = 0
+        # kbit/s of the last progress line that told it, None otherwise
+        self.rate = None
+        self.log = []
+        self.on_update = on_update
+        self._line = ''
+
+    def write(self, string):
+        # keep whole lines only, esptool writes line fragments
+        self._line += string
+        *lines, self._line = self._line.split('\n')
+        for line in lines:
+            self.add_line(line)
+
+    def flush(self):
+        if self._line:
+            self.add_line(self._line)
+            self._line = ''
+
+    def isatty(self):
+        return False
+
+    def add_line(self, line):
+        line = line.rstrip('\r')
+        self.log.append(line)
+        match = PROGRESS_RE.search(line)
+        if match:
+            self.progress = int(match.group(1))
+            rate = RATE_RE.search(line)
+            self.rate = float(rate.group(1)) if rate else None
+        self.notify(line)
+
+    def set_status(self, status):
+        self.status = status
+        if status == self.DONE:
+            self.progress = 100
+        if status != self.RUNNING:
+            self.rate = None
+        self.notify(None)
+
+    def notify(self, line):
+        if self.on_update is not None:
+            self.on_update(self, line)
+
+
+class ParallelFlasher:
+    '''Run the same job on a group of ports at once, one worker per port
+
+    job is called as job(port) from the worker thread with stdout routed
+    into that port's PortWorker and must return True on success. A failing
+    or crashing board only marks its own worker as failed.
+    '''
+    def __init__(self, ports, on_update=None):
+        self.workers = [PortWorker(port, on_update) for port in ports]
+
+    def run(self, job):
+        stream = install_routed_stdout()
+        if not self.workers:
+            return []
+
+        def work(worker):
+            stream.route(worker)
+            worker.set_status(PortWorker.RUNNING)
+            try:
+                ok = job(worker.port)
+            except Exception as e:
+                print('--- ERROR ---')
+                print(e)
+                ok = False
+            finally:
+                worker.flush()
+                stream.unroute()
+            worker.set_status(PortWorker.DONE if ok else PortWorker.FAILED)
+            return ok
+
+        with ThreadPoolExecutor(max_workers=len(self.workers), thread_name_prefix='flash') as pool:
+            results = list(pool.map(work, self.workers))
+        return results
@@ -0,0 +1,775 @@
+'''Operations on a connected, stub-loaded esptool loader. No wx here.
+
+Everything goes through esptool's Python API rather than its command line,
+so one connection can serve several operations (FlashSession), images are
+compressed once and sent as is to every board, and a write can be limited
+to the parts of an image that actually need it.
+'''
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import hashlib
+import argparse
+import threading
+import serial
+import esptool
+import dfu_baud
+import dfu_metrics
+from esptool.loader import DEFAULT_CONNECT_ATTEMPTS, DEFAULT_TIMEOUT, ERASE_WRITE_TIMEOUT_PER_MB, timeout_per_mb
+
+SECTOR_SIZE = 0x1000
+# flash MD5s are first compared over this many bytes, then sector by sector
+PROBE_SIZE = 16 * SECTOR_SIZE
+# images with less than this in 0xFF sectors are written in full, see sparse_write()
+SPARSE_MIN_BYTES = 16 * SECTOR_SIZE
+# flash checked against the image before resuming an interrupted write
+RESUME_CHECK_SIZE = 16 * SECTOR_SIZE
+# reconnections to resume a write cut by a link error, at a fixed baud rate
+WRITE_RETRIES = 2
+# stages resumed on a new connection after a link error
+RESUMABLE_STAGES = ('write', 'read')
+# flash read back and written to disk at a time, see read_to_file()
+READ_CHUNK_SIZE = 64 * SECTOR_SIZE
+# read back after a baud change to check the link in auto mode
+BAUD_PROBE_SIZE = 4 * SECTOR_SIZE
+# what a failing link raises: a timeout or bad reply inside esptool's SLIP
+# reader ends that generator, and the next read of the loader then raises
+# a bare StopIteration until flush_input() makes a new one
+LINK_ERRORS = (esptool.FatalError, serial.SerialException, OSError, StopIteration)
+
+
+class VerifyError(esptool.FatalError):
+    '''Flash content differs from the image, a slower link won't fix that'''
+
+
+def connect(port, baud, chip, before='default_reset', job=None):
+    '''Open the port, sync, load the stub and switch baud rate, like esptool.main does.
+
+    A port of None probes every port. Returns the stub loader. The stages
+    are timed in job (a dfu_metrics.JobRecord) when given; opening the
+    port, reset, sync and chip detection are a single esptool call, timed
+    together as 'connect'.
+    '''
+    job = job or dfu_metrics.JobRecord()
+    baud = int(baud)
+    initial_baud = min(esptool.ESPLoader.ESP_ROM_BAUD, baud)
+    ports = [port] if port is not None else esptool.get_port_list()
+    with job.stage('connect'):
+        esp = esptool.get_default_connected_device(ports, port=port, connect_attempts=DEFAULT_CONNECT_ATTEMPTS,
+                                                   initial_baud=initial_baud, chip=chip, before=before)
+        if esp is None:
+            raise esptool.FatalError('Could not connect to an Espressif device on any of the %d available serial ports.' % len(ports))
+
+    job.chip = esp.get_chip_description()
+    print('Chip is %s' % job.chip)
+    with job.stage('stub'):
+        esp = esp.run_stub()
+    if baud > initial_baud:
+        with job.stage('baud'):
+            esp.change_baud(baud)
+    return esp
+
+
+def pad_image(data):
+    '''esptool writes images padded with 0xFF to a multiple of 4 bytes'''
+    return data + b'\xff' * (-len(data) % 4)
+
+
+def deflate_blocks(compressed, block_size):
+    '''Cut a zlib stream into FLASH_DEFL_DATA blocks
+
+    Returns [(block, checksum, uncompressed size)], the blocks being
+    memoryviews into compressed so nothing is copied.
+    '''
+    view = memoryview(compressed)
+    decompress = zlib.decompressobj()
+    blocks = []
+    for offset in range(0, len(compressed), block_size):
+        block = view[offset:offset + block_size]
+        blocks.append((block, esptool.ESPLoader.checksum(block), len(decompress.decompress(block))))
+    return blocks
+
+
+def image_blocks(image, block_size):
+    '''deflate_blocks() of image.deflated(), computed once per block size'''
+    compressed = image.deflated()
+    with image.lock:
+        if block_size not in image.deflate_blocks:
+            image.deflate_blocks[block_size] = deflate_blocks(compressed, block_size)
+        return image.deflate_blocks[block_size]
+
+
+def defl_block(esp, block, checksum, seq, timeout):
+    '''esp.flash_defl_block() with a precomputed checksum
+
+    Unlike esptool, a block whose reply is lost is not sent again: the
+    loader may have inflated it already, and would then write it twice.
+    The input is flushed (a new SLIP reader) and the error raised, so the
+    write resumes from its checkpoint on a fresh stream, see FlashSession.run().
+    '''
+    try:
+        esp.check_command('write compressed data to flash after seq %d' % seq, esp.ESP_FLASH_DEFL_DATA,
+                          struct.pack('<IIII', len(block), seq, 0, 0) + block, checksum, timeout=timeout)
+    except (esptool.FatalError, StopIteration) as e:
+        esp.flush_input()
+        raise esptool.FatalError('No answer to the compressed block after seq %d (%s)' % (seq, e or 'reader ended')) from e
+
+
+def send_deflated(esp, address, uncsize, compressed, blocks, confirm=None):
+    '''Compressed write of deflate_blocks() at address, the same protocol write_flash uses
+
+    confirm(nbytes) is called with the bytes known to be in flash as the
+    blocks are acknowledged.
+    '''
+    if esp.flash_defl_begin(uncsize, len(compressed), address) != len(blocks):
+        raise esptool.FatalError('Compressed blocks do not match the flash write size of the loader')
+
+    timeout = DEFAULT_TIMEOUT
+    written = 0
+    for seq, (block, checksum, block_uncompressed) in enumerate(blocks):
+        print('Writing at 0x%08x... (%d %%)' % (address + written, 100 * (seq + 1) // len(blocks)))
+        if confirm and esp.IS_STUB:
+            # the stub writes a block while it receives the next one
+            confirm(written)
+        written += block_uncompressed
+        block_timeout = max(DEFAULT_TIMEOUT, timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, block_uncompressed))
+        if not esp.IS_STUB:
+            # ROM code writes block to flash before ACKing
+            timeout = block_timeout
+        defl_block(esp, block, checksum, seq, timeout)
+        if confirm and not esp.IS_STUB:
+            confirm(written)
+        if esp.IS_STUB:
+            # stub ACKs on receive and writes while receiving the next block
+            timeout = block_timeout
+
+    if esp.IS_STUB:
+        # not ACKed until the last block is actually written
+        esp.read_reg(esptool.ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR, timeout=timeout)
+    if confirm:
+        confirm(written)
+    return len(compressed)
+
+
+def write_region(esp, address, data):
+    '''Compress data and write it at address'''
+    compressed = zlib.compress(data, 9)
+    return send_deflated(esp, address, len(data), compressed, deflate_blocks(compressed, esp.FLASH_WRITE_SIZE))
+
+
+class WriteCheckpoint:
+    '''Bytes of each image one board has acknowledged, to resume an interrupted write
+
+    Keyed by address and image SHA-256, so another image at the same
+    address starts from the beginning. Images written and verified stay
+    marked done until the whole write succeeds, so a retry skips them.
+    '''
+    def __init__(self):
+        self.confirmed = {}
+
+    def get(self, address, image):
+        return self.confirmed.get((address, image.digest()), 0)
+
+    def confirm(self, address, image, nbytes):
+        self.confirmed[(address, image.digest())] = nbytes
+
+    def done(self, address, image):
+        self.confirmed[(address, image.digest())] = len(image.data)
+
+    def forget(self, address, image):
+        self.confirmed.pop((address, image.digest()), None)
+
+    def clear(self):
+        self.confirmed.clear()
+
+
+class Checkpoints:
+    '''WriteCheckpoint of every board by MAC, so a new connection or session can resume a failed write'''
+    def __init__(self):
+        self.boards = {}
+        self.lock = threading.Lock()
+
+    def board(self, mac):
+        with self.lock:
+            return self.boards.setdefault(mac, WriteCheckpoint())
+
+
+def resume_point(esp, address, image, checkpoint):
+    '''Offset of image to carry on writing from, 0 unless checkpoint has some of it in flash
+
+    The confirmed bytes are rounded down to a sector, and the last
+    RESUME_CHECK_SIZE bytes before that are compared by MD5 with the
+    flash; the whole image is verified once written anyway. An image
+    already done is checked whole, and len(image) returned if it matches.
+    '''
+    if checkpoint is None or address % SECTOR_SIZE:
+        return 0
+    confirmed = checkpoint.get(address, image)
+    if confirmed >= len(image.data):
+        start, low = len(image.data), 0
+    else:
+        start = confirmed - confirmed % SECTOR_SIZE
+        low = max(0, start - RESUME_CHECK_SIZE)
+    if start <= 0:
+        return 0
+    if esp.flash_md5sum(address + low, start - low) != hashlib.md5(image.data[low:start]).hexdigest():
+        print('Flash no longer holds the start of %s, writing it again' % image.name)
+        checkpoint.forget(address, image)
+        return 0
+    if start == len(image.data):
+        print('%s is already written at 0x%08x, skipped' % (image.name, address))
+        return start
+    print('Resuming %s at 0x%08x, %d of %d bytes already in flash' % (image.name, address + start, start, len(image)))
+    return start
+
+
+def confirmer(checkpoint, address, image, start):
+    '''confirm callback of send_deflated() for a stream starting at offset start of image'''
+    if checkpoint is None:
+        return None
+    return lambda nbytes: checkpoint.confirm(address, image, start + nbytes)
+
+
+def verify_image(esp, address, image, checkpoint=None):
+    if esp.flash_md5sum(address, len(image.data)) != image.digest('md5'):
+        if checkpoint is not None:
+            checkpoint.forget(address, image)
+        raise VerifyError('MD5 of %s does not match data in flash!' % image.name)
+    if checkpoint is not None:
+        checkpoint.done(address, image)
+
+
+def write_image(esp, address, image, checkpoint=None, start=None):
+    '''Write a whole image at address from its shared, precompressed blocks and verify it
+
+    With a WriteCheckpoint, a write interrupted earlier carries on where
+    the board stopped acknowledging blocks (or from start when known).
+    '''
+    t = time.time()
+    if start is None:
+        start = resume_point(esp, address, image, checkpoint)
+    if start:
+        compressed, blocks = region_blocks(image, start, len(image), esp.FLASH_WRITE_SIZE)
+    else:
+        compressed, blocks = image.deflated(), image_blocks(image, esp.FLASH_WRITE_SIZE)
+    send_deflated(esp, address + start, len(pad_image(image.data[start:])), compressed, blocks,
+                  confirmer(checkpoint, address, image, start))
+    sys.stdout.flush()
+    verify_image(esp, address, image, checkpoint)
+    print('Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds.'
+          % (len(image) - start, len(compressed), address + start, time.time() - t))
+    print('Hash of data verified.')
+    return len(image) - start
+
+
+def region_blocks(image, start, end, block_size):
+    '''(compressed, deflate_blocks()) of image.data[start:end], computed once for every board'''
+    key = (start, end, block_size)
+    with image.lock:
+        if key not in image.deflate_blocks:
+            compressed = zlib.compress(pad_image(image.data[start:end]), 9)
+            image.deflate_blocks[key] = (compressed, deflate_blocks(compressed, block_size))
+        return image.deflate_blocks[key]
+
+
+def covered(intervals, start, end):
+    return any(low <= start and end <= high for low, high in intervals)
+
+
+def sparse_write(esp, address, image, erased=(), checkpoint=None, resume=None):
+    '''Write image, leaving out its 0xFF sectors where the flash is already erased
+
+    A run of 0xFF sectors is skipped when it lies in one of the erased
+    [(start, end)] flash intervals, or when its flash MD5 is that of erased
+    flash. The rest is sent in extents whose compressed blocks are shared
+    by every board. A write interrupted earlier resumes as in write_image().
+    Returns the number of bytes written.
+    '''
+    t = time.time()
+    if resume is None:
+        resume = resume_point(esp, address, image, checkpoint)
+    skipped = []
+    for start, end in image.erased_runs(SECTOR_SIZE):
+        if end <= resume or covered(erased, address + start, address + end) or \
+                esp.flash_md5sum(address + start, end - start) == hashlib.md5(b'\xff' * (end - start)).hexdigest():
+            skipped.append((start, end))
+    if not skipped:
+        return write_image(esp, address, image, checkpoint, resume)
+
+    extents = []
+    position = resume
+    for start, end in skipped:
+        if start > position:
+            extents.append((position, start))
+        position = max(position, end)
+    if position < len(image):
+        extents.append((position, len(image)))
+
+    written = 0
+    for start, end in extents:
+        compressed, blocks = region_blocks(image, start, end, esp.FLASH_WRITE_SIZE)
+        send_deflated(esp, address + start, len(pad_image(image.data[start:end])), compressed, blocks,
+                      confirmer(checkpoint, address, image, start))
+        written += end - start
+    sys.stdout.flush()
+
+    verify_image(esp, address, image, checkpoint)
+    print('Wrote %d of %d bytes of %s at 0x%08x in %.1f seconds, %d erased bytes skipped, hash of data verified.'
+          % (written, len(image), image.name, address, time.time() - t, len(image) - resume - written))
+    return written
+
+
+def finish_write(esp):
+    '''End a series of writes without leaving the loader, as write_flash does'''
+    if esp.IS_STUB:
+        esp.flash_begin(0, 0)
+        esp.flash_defl_finish(False)
+
+
+def write_images(esp, images, erased=(), checkpoint=None):
+    '''Write [(address, FirmwareImage)] in address order, returns the bytes written
+
+    Images with enough 0xFF sectors go through sparse_write(), erased being
+    the [(start, end)] flash intervals known to be erased. Progress is kept
+    in checkpoint (a WriteCheckpoint) when given, and resumed from.
+    '''
+    written = 0
+    for address, image in sorted(images, key=lambda pair: int(pair[0], 0)):
+        address = int(address, 0)
+        start = resume_point(esp, address, image, checkpoint)
+        if start == len(image.data):
+            continue
+        blank = sum(high - low for low, high in image.erased_runs(SECTOR_SIZE))
+        if address % SECTOR_SIZE == 0 and blank >= SPARSE_MIN_BYTES:
+            written += sparse_write(esp, address, image, erased, checkpoint, start)
+        else:
+            written += write_image(esp, address, image, checkpoint, start)
+    finish_write(esp)
+    return written
+
+
+def changed_sectors(esp, address, image):
+    '''Indexes of the sectors of image whose content differs in flash at address
+
+    One MD5 of the whole image first, then of every PROBE_SIZE chunk, and
+    sector by sector only inside the chunks that differ.
+    '''
+    data = image.data
+    if esp.flash_md5sum(address, len(data)) == image.digest('md5'):
+        return []
+
+    chunk_digests = image.block_md5s(PROBE_SIZE)
+    sector_digests = image.block_md5s(SECTOR_SIZE)
+    per_chunk = PROBE_SIZE // SECTOR_SIZE
+
+    changed = []
+    for chunk, digest in enumerate(chunk_digests):
+        start = chunk * PROBE_SIZE
+        length = min(PROBE_SIZE, len(data) - start)
+        if esp.flash_md5sum(address + start, length) == digest:
+            continue
+        for sector in range(chunk * per_chunk, min((chunk + 1) * per_chunk, len(sector_digests))):
+            offset = sector * SECTOR_SIZE
+            length = min(SECTOR_SIZE, len(data) - offset)
+            if esp.flash_md5sum(address + offset, length) != sector_digests[sector]:
+                changed.append(sector)
+    return changed
+
+
+def sector_runs(sectors):
+    '''Group sorted sector indexes into contiguous [start, end) runs'''
+    runs = []
+    for sector in sectors:
+        if runs and runs[-1][1] == sector:
+            runs[-1][1] = sector + 1
+        else:
+            runs.append([sector, sector + 1])
+    return runs
+
+
+def smart_write(esp, address, image):
+    '''Write only the sectors of image that differ from the flash content
+
+    Returns the number of bytes written. Falls back to a full write if the
+    address isn't sector aligned.
+    '''
+    data = pad_image(image.data)
+    total = (len(data) + SECTOR_SIZE - 1) // SECTOR_SIZE
+    t = time.time()
+
+    if address % SECTOR_SIZE:
+        print('0x%08x is not sector aligned, writing %s in full' % (address, image.name))
+        changed = list(range(total))
+    else:
+        print('Comparing %s with flash at 0x%08x...' % (image.name, address))
+        changed = changed_sectors(esp, address, image)
+
+    if not changed:
+        print('%s is already in flash, skipped (checked in %.1f seconds)' % (image.name, time.time() - t))
+        return 0
+    if len(changed) == total:
+        # nothing to skip, the precompressed image is the cheapest to send
+        write_image(esp, address, image)
+        return len(data)
+
+    written = 0
+    for start, end in sector_runs(changed):
+        region = data[start * SECTOR_SIZE:end * SECTOR_SIZE]
+        write_region(esp, address + start * SECTOR_SIZE, region)
+        written += len(region)
+    sys.stdout.flush()
+
+    if esp.flash_md5sum(address, len(image.data)) != image.digest('md5'):
+        raise VerifyError('MD5 of %s does not match data in flash!' % image.name)
+    print('Wrote %d of %d sectors of %s at 0x%08x in %.1f seconds, hash of data verified.'
+          % (len(changed), total, image.name, address, time.time() - t))
+    return written
+
+
+def smart_write_images(esp, images):
+    '''smart_write() every [(address, FirmwareImage)], returns the bytes written'''
+    written = 0
+    for address, image in sorted(images, key=lambda pair: int(pair[0], 0)):
+        written += smart_write(esp, int(address, 0), image)
+    finish_write(esp)
+    size = sum(len(image) for _, image in images)
+    print('Smart flash: wrote %d of %d bytes' % (written, size))
+    return written
+
+
+def read_to_file(esp, address, size, path, mac=None, chunk_size=READ_CHUNK_SIZE):
+    '''Stream size bytes of flash at address to path, chunk_size at a time. Returns the bytes read
+
+    Only one chunk is ever held in memory. The dump grows in path.part and
+    path.part.json records how much of it is complete, for which board and
+    range, so an interrupted dump of the same range of the same board (mac)
+    carries on from its last complete chunk. path only appears once whole.
+    '''
+    part = path + '.part'
+    state_path = part + '.json'
+    state = {'mac': mac, 'address': address, 'size': size, 'done': 0}
+    try:
+        with open(state_path) as file:
+            saved = json.load(file)
+        if all(saved.get(key) == state[key] for key in ('mac', 'address', 'size')):
+            state['done'] = min(saved['done'], os.path.getsize(part))
+    except (OSError, ValueError, KeyError):
+        pass
+    start = state['done']
+    if start:
+        print('Resuming the dump of %s at 0x%08x' % (path, address + start))
+
+    t = time.time()
+    with open(part, 'r+b' if start else 'wb') as file:
+        file.truncate(start)
+        file.seek(start)
+        while state['done'] < size:
+            length = min(chunk_size, size - state['done'])
+            file.write(esp.read_flash(address + state['done'], length))
+            file.flush()
+            os.fsync(file.fileno())
+            state['done'] += length
+            tmp = state_path + '.tmp'
+            with open(tmp, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp, state_path)
+            seconds = time.time() - t
+            print('Read %d of %d bytes at 0x%08x (%d %%), %.1f kbit/s'
+                  % (state['done'], size, address, 100 * state['done'] // size,
+                     (state['done'] - start) * 8 / seconds / 1000 if seconds else 0))
+    os.replace(part, path)
+    os.remove(state_path)
+    # the progress lines above go to the port list of the GUI, the console gets the average
+    seconds = time.time() - t
+    print('Read 0x%x bytes at 0x%08x to %s in %.1f seconds (%.1f kbit/s).'
+          % (size, address, path, seconds, (size - start) * 8 / seconds / 1000 if seconds else 0))
+    return size - start
+
+
+class FlashSession:
+    '''One connection to one board, shared by any number of operations.
+
+    Reset, sync, chip detection, stub upload and baud change happen once in
+    open(); erase, write, verify, md5 and reset then run on the same stub.
+    The time spent in open() is measured, and report() tells how much a
+    connection per operation would have cost on top.
+
+    A write cut by a link error is resumed on a new connection from the
+    last blocks the board acknowledged, see WriteCheckpoint, and a read
+    from its last complete chunk, see read_to_file().
+    '''
+    def __init__(self, port, baud, chip, before='default_reset', profiles=None, job=None, checkpoints=None):
+        self.port = port
+        self.baud = str(baud)
+        self.chip = chip
+        self.before = before
+        # dfu_baud.BaudProfiles consulted and updated with baud 'auto'
+        self.profiles = profiles
+        # dfu_metrics.JobRecord the stages are timed in, see use()
+        self.job = job or dfu_metrics.JobRecord(port, baud)
+        # Checkpoints of the boards, shared with later sessions to resume their writes
+        self.checkpoints = checkpoints or Checkpoints()
+        self.rate = None
+        self.mac = None
+        # [(start, end)] of flash erased on this session and not written since
+        self.erased = []
+        self.esp = None
+        self.setup_seconds = 0.0
+        self.operations = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        t = time.time()
+        if self.baud == dfu_baud.AUTO:
+            if self.before == 'no_reset':
+                # a failed probe is retried from the ROM rate, which takes a reset: the stub stays at the rate that failed
+                raise esptool.FatalError("baud 'auto' needs the board reset before connecting, not no_reset")
+            self.open_auto()
+        else:
+            self.esp = connect(self.port, self.baud, self.chip, self.before, self.job)
+            self.port = self.esp._port.port
+            self.rate = int(self.baud)
+        self.job.port = self.port
+        self.job.baud = str(self.rate)
+        with self.job.stage('mac'):
+            self.mac = ':'.join('%02x' % byte for byte in self.esp.read_mac())
+        self.job.mac = self.mac
+        self.setup_seconds = time.time() - t
+        self.operations = 0
+        print('Connected in %.1f seconds' % self.setup_seconds)
+
+    def use(self, job):
+        '''Time the following operations in another JobRecord, the connection is reused'''
+        job.port, job.baud, job.chip, job.mac = self.port, str(self.rate), self.job.chip, self.mac
+        self.job = job
+
+    def open_auto(self, rate=None):
+        '''Connect, then step down from rate (the adapter's known good one by default) until the link holds'''
+        while True:
+            self.esp = connect(self.port, esptool.ESPLoader.ESP_ROM_BAUD, self.chip, self.before, self.job)
+            self.port = self.esp._port.port
+            if rate is None:
+                rate = self.profiles.start_rate(self.port) if self.profiles else dfu_baud.RATES[0]
+            try:
+                if rate > esptool.ESPLoader.ESP_ROM_BAUD:
+                    with self.job.stage('baud', BAUD_PROBE_SIZE):
+                        self.esp.change_baud(rate)
+                        self.esp.read_flash(0, BAUD_PROBE_SIZE)
+                break
+            except LINK_ERRORS as e:
+                print(e)
+                self.drop()
+                self.record(rate, False)
+                rate = dfu_baud.slower(rate)
+        self.rate = rate
+        self.record(rate, True)
+
+    def record(self, rate, ok):
+        if self.profiles is not None:
+            self.profiles.record(self.port, rate, ok)
+
+    def reconnect(self):
+        '''After a link error, carry on with the same connection if the stub still answers, else connect again at the same rate'''
+        if self.alive():
+            return
+        self.drop()
+        self.esp = connect(self.port, self.rate, self.chip, self.before, self.job)
+
+    def run(self, stage, nbytes, func, *args):
+        '''Run an operation timed as stage; with baud 'auto', again at a slower rate when the link fails
+
+        A write or read is also run again at the same rate, up to
+        WRITE_RETRIES times, and resumes where it stopped (see reconnect()).
+        '''
+        self.operations += 1
+        retries = WRITE_RETRIES if stage in RESUMABLE_STAGES else 0
+        while True:
+            try:
+                with self.job.stage(stage, nbytes) as entry:
+                    result = func(*args)
+                    if stage in RESUMABLE_STAGES:
+                        # smart flash and resumed operations move fewer bytes than asked
+                        entry['bytes'] = result
+                return result
+            except VerifyError:
+                raise
+            except LINK_ERRORS as e:
+                if self.baud == dfu_baud.AUTO and dfu_baud.slower(self.rate) is not None:
+                    print(e)
+                    print('Link error at %d baud, reconnecting slower' % self.rate)
+                    self.record(self.rate, False)
+                    self.drop()
+                    self.open_auto(dfu_baud.slower(self.rate))
+                elif retries:
+                    retries -= 1
+                    print(e)
+                    print('Link error during the %s, reconnecting to resume it' % stage)
+                    self.reconnect()
+                elif isinstance(e, StopIteration):
+                    raise esptool.FatalError('No answer from the board during the %s' % stage) from e
+                else:
+                    raise
+
+    def alive(self):
+        '''Whether the stub still answers on this connection'''
+        if self.esp is None:
+            return False
+        try:
+            # stale input out, and a new SLIP reader in case the last one ended on an error
+            self.esp.flush_input()
+            self.esp.read_reg(esptool.ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR, timeout=0.5)
+            return True
+        except LINK_ERRORS:
+            return False
+
+    def drop(self):
+        '''Close the port without ending the session'''
+        try:
+            self.esp._port.close()
+        except OSError:
+            pass
+        self.esp = None
+
+    def close(self):
+        if self.esp is None:
+            return
+        self.drop()
+        self.report()
+
+    def report(self):
+        if self.operations > 1:
+            print('Session on %s: %d operations on one connection, setup took %.1f seconds once, saving about %.1f seconds'
+                  % (self.port, self.operations, self.setup_seconds, self.saved_seconds()))
+
+    def saved_seconds(self):
+        '''Setup time a connection per operation would have cost on top of this session'''
+        return self.setup_seconds * max(0, self.operations - 1)
+
+    ################################################################
+    #                         OPERATIONS                           #
+    ################################################################
+    def erase_flash(self):
+        self.run('erase', 0, lambda: esptool.cmds.erase_flash(self.esp, argparse.Namespace(force=False)))
+        self.erased = [(0, 1 << 32)]
+        self.checkpoint().clear()
+
+    def erase_region(self, offset, size):
+        self.run('erase region', size,
+                 lambda: esptool.cmds.erase_region(self.esp, argparse.Namespace(force=False, address=offset, size=size)))
+        self.erased.append((offset, offset + size))
+        self.checkpoint().clear()
+
+    def erase_regions(self, regions):
+        '''Erase [(offset, size)] sector aligned regions, see dfu_partitions.erase_plan()'''
+        for offset, size in regions:
+            print('Erasing 0x%08x-0x%08x...' % (offset, offset + size))
+            self.erase_region(offset, size)
+
+    def checkpoint(self):
+        '''WriteCheckpoint of the board on this session'''
+        return self.checkpoints.board(self.mac)
+
+    def write(self, images, smart=False):
+        '''Write [(address, FirmwareImage)], with smart only the sectors that changed'''
+        for _, image in images:
+            self.job.images[image.name] = image.digest()
+        try:
+            if smart:
+                self.run('write', 0, lambda: smart_write_images(self.esp, images))
+            else:
+                self.run('write', 0, lambda: write_images(self.esp, images, self.erased, self.checkpoint()))
+            self.checkpoint().clear()
+        finally:
+            self.erased = []
+
+    def dump(self, regions):
+        '''Stream every [(address, size, path)] of flash to its file, see read_to_file()'''
+        for address, size, path in regions:
+            self.run('read', size, lambda: read_to_file(self.esp, address, size, path, self.mac))
+
+    def md5(self, address, size, stage='md5'):
+        '''Flash MD5 of size bytes at address, computed by the stub and timed as stage'''
+        return self.run(stage, size, lambda: self.esp.flash_md5sum(address, size))
+
+    def verify(self, images):
+        '''Compare the flash MD5 of every [(address, FirmwareImage)] with the image
+
+        The image MD5 is computed once (usually in the background when the
+        image is loaded), so verifying a board only costs the MD5 the stub
+        computes over the flash, one 'verify' stage per image. The digests
+        read back go to the job record.
+        '''
+        for address, image in images:
+            digest = self.md5(int(address, 0), len(image.data), 'verify')
+            self.job.verified[image.name] = digest
+            if digest != image.digest('md5'):
+                raise VerifyError('Verify failed: %s at %s does not match flash' % (image.name, address))
+            print('Verify OK: %s at %s' % (image.name, address))
+
+    def reset(self, after='hard_reset'):
+        '''Leave the stub and end the session (no_reset keeps the board in the stub)'''
+        if after == 'hard_reset':
+            print('Hard resetting via RTS pin...')
+            with self.job.stage('reset'):
+                self.esp.hard_reset()
+        self.close()
+
+
+class SessionPool:
+    '''Open FlashSessions by port, so consecutive operations on a board share one connection'''
+    def __init__(self, profiles=None, checkpoints=None):
+        self.sessions = {}
+        self.profiles = profiles
+        self.checkpoints = checkpoints
+        self.lock = threading.Lock()
+
+    def get(self, port, baud, chip, before='default_reset', job=None):
+        '''The open session of port, (re)connecting when needed. Stages are timed in job'''
+        with self.lock:
+            session = self.sessions.pop(port, None) if port is not None else None
+        if session is not None:
+            if session.baud == str(baud) and session.chip == chip and session.alive():
+                print('Reusing the connection to ' + session.port)
+                if job is not None:
+                    session.use(job)
+                return self.put(session)
+            session.close()
+
+        session = FlashSession(port, baud, chip, before, self.profiles, job, self.checkpoints)
+        session.open()
+        return self.put(session)
+
+    def put(self, session):
+        with self.lock:
+            self.sessions[session.port] = session
+        return session
+
+    def release(self, port, after=None):
+        '''Close the session of port, resetting the board first if after is given'''
+        with self.lock:
+            session = self.sessions.pop(port, None)
+        if session is None:
+            return False
+        if after is not None:
+            session.reset(after)
+        else:
+            session.close()
+        return True
+
+    def close_all(self, after=None):
+        with self.lock:
+            ports = list(self.sessions)
+        for port in ports:
+            try:
+                self.release(port, after)
+            except LINK_ERRORS as e:
+                print(e)
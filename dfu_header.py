@@ -0,0 +1,201 @@
+'''ESP image headers of the bootloader and app, read on the host. No wx, no esptool here.
+
+Both images start with the header the ROM loader reads: magic 0xE9, the
+segment count, SPI flash mode, flash size and frequency, and the entry
+point. ESP32 family images follow it with an extended header holding the
+chip id and whether a SHA-256 of the image is appended. Then come the
+segments, a checksum byte and the optional SHA-256.
+
+Parsing them once per load tells which chip the project is built for, so
+the chip can be chosen before connecting (no detection round trip), and
+a truncated, corrupt or mismatched image is refused before any port is
+opened. The result is small and kept in the firmware cache (see
+dfu_cache.FirmwareCache.headers()).
+'''
+import struct
+import hashlib
+
+ESP_IMAGE_MAGIC = 0xE9
+HEADER_FMT = '<BBBBI'
+EXTENDED_HEADER_FMT = '<BBBBHBHH4sB'
+SEGMENT_HEADER_FMT = '<II'
+CHECKSUM_SEED = 0xEF
+MAX_SEGMENTS = 16
+
+# roles whose images carry an ESP image header
+HEADER_ROLES = ('bootloader', 'app')
+
+CHIP_IDS = {0: 'esp32', 2: 'esp32s2', 5: 'esp32c3', 9: 'esp32s3', 12: 'esp32c2', 13: 'esp32c6', 16: 'esp32h2'}
+
+# where the ROM loader looks for the bootloader
+BOOTLOADER_ADDRESSES = {'esp8266': 0x0, 'esp32': 0x1000, 'esp32s2': 0x1000}
+DEFAULT_BOOTLOADER_ADDRESS = 0x0
+
+FLASH_MODES = {0: 'qio', 1: 'qout', 2: 'dio', 3: 'dout'}
+FLASH_SIZES = {0: '1MB', 1: '2MB', 2: '4MB', 3: '8MB', 4: '16MB', 5: '32MB', 6: '64MB', 7: '128MB'}
+ESP8266_FLASH_SIZES = {0: '512KB', 1: '256KB', 2: '1MB', 3: '2MB', 4: '4MB', 5: '2MB-c1', 6: '4MB-c1', 8: '8MB', 9: '16MB'}
+FLASH_FREQUENCIES = {0xF: '80m', 0x0: '40m', 0x1: '26m', 0x2: '20m'}
+CHIP_FLASH_FREQUENCIES = {
+    'esp32c2': {0xF: '60m', 0x0: '30m', 0x1: '20m', 0x2: '15m'},
+    'esp32c6': {0x0: '80m', 0x2: '20m'},
+    'esp32h2': {0xF: '48m', 0x0: '24m', 0x1: '16m', 0x2: '12m'},
+}
+
+
+def xor_bytes(data):
+    '''XOR of every byte of data, folded in halves to stay in C'''
+    value = int.from_bytes(data, 'little')
+    width = len(data)
+    while width > 1:
+        half = (width + 1) // 2
+        value = (value & ((1 << 8 * half) - 1)) ^ (value >> 8 * half)
+        width = half
+    return value & 0xFF
+
+
+class ImageHeader:
+    '''What the header and trailer of one ESP image say'''
+    def __init__(self, chip, chip_id, flash_mode, flash_size, flash_freq, entry, segments, length, sha256=None):
+        self.chip = chip
+        self.chip_id = chip_id
+        self.flash_mode = flash_mode
+        self.flash_size = flash_size
+        self.flash_freq = flash_freq
+        self.entry = entry
+        # [(load address, offset in the image, size)]
+        self.segments = segments
+        # bytes up to the checksum, or the appended SHA-256
+        self.length = length
+        self.sha256 = sha256
+
+    @classmethod
+    def from_dict(cls, data):
+        header = cls(**data)
+        header.segments = [tuple(segment) for segment in header.segments]
+        return header
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return '%s image, %s %s %s, entry 0x%08x, %d segments%s' % (
+            self.chip, self.flash_mode, self.flash_size, self.flash_freq, self.entry, len(self.segments),
+            ', SHA-256 ok' if self.sha256 else '')
+
+
+def read_segments(data, offset, count, name):
+    '''[(load address, offset, size)] of count segments from offset, and the checksum they add up to'''
+    segments = []
+    checksum = CHECKSUM_SEED
+    for index in range(count):
+        if offset + 8 > len(data):
+            raise ValueError('%s is truncated in the header of segment %d' % (name, index))
+        load_address, size = struct.unpack_from(SEGMENT_HEADER_FMT, data, offset)
+        offset += 8
+        if offset + size > len(data):
+            raise ValueError('%s is truncated in segment %d (0x%x bytes at 0x%x)' % (name, index, size, offset))
+        segments.append((load_address, offset, size))
+        checksum ^= xor_bytes(data[offset:offset + size])
+        offset += size
+    return segments, checksum, offset
+
+
+def check_checksum(data, offset, checksum, name):
+    '''Offset just past the checksum byte, which sits on the last byte of a 16 byte line'''
+    offset += 15 - offset % 16
+    if offset >= len(data):
+        raise ValueError('%s is truncated before its checksum' % name)
+    if data[offset] != checksum:
+        raise ValueError('%s is corrupt: checksum 0x%02x, the segments add up to 0x%02x' % (name, data[offset], checksum))
+    return offset + 1
+
+
+def parse_header(data, name='image'):
+    '''ImageHeader of a bootloader or app image, ValueError if it isn't a sound ESP image
+
+    ESP8266 images have no extended header: bytes 12-13, where the chip id
+    of the others is, hold half the size of their first segment. An image
+    whose chip id is known but that doesn't parse as such is tried as an
+    ESP8266 one before it is refused.
+    '''
+    if len(data) < 24 or data[0] != ESP_IMAGE_MAGIC:
+        raise ValueError('%s is not an ESP image (no 0x%02x magic byte)' % (name, ESP_IMAGE_MAGIC))
+    _, count, _, _, _ = struct.unpack_from(HEADER_FMT, data, 0)
+    if not 0 < count <= MAX_SEGMENTS:
+        raise ValueError('%s is corrupt: %d segments' % (name, count))
+    extended = struct.unpack_from(EXTENDED_HEADER_FMT, data, 8)
+    chip_id, hash_appended = extended[4], extended[-1]
+
+    if chip_id not in CHIP_IDS:
+        return parse_image(data, name, 'esp8266', None, 0)
+    try:
+        return parse_image(data, name, CHIP_IDS[chip_id], chip_id, hash_appended)
+    except ValueError as error:
+        try:
+            return parse_image(data, name, 'esp8266', None, 0)
+        except ValueError:
+            raise error
+
+
+def parse_image(data, name, chip, chip_id, hash_appended):
+    '''ImageHeader of data laid out as an image of chip, ValueError if it isn't one'''
+    _, count, mode, size_freq, entry = struct.unpack_from(HEADER_FMT, data, 0)
+    if chip == 'esp8266':
+        segments, checksum, offset = read_segments(data, 8, count, name)
+        sizes = ESP8266_FLASH_SIZES
+    else:
+        segments, checksum, offset = read_segments(data, 24, count, name)
+        sizes = FLASH_SIZES
+    offset = check_checksum(data, offset, checksum, name)
+
+    sha256 = None
+    if hash_appended == 1:
+        sha256 = data[offset:offset + 32].hex()
+        if hashlib.sha256(data[:offset]).hexdigest() != sha256:
+            raise ValueError('%s is corrupt: its appended SHA-256 does not match' % name)
+        offset += 32
+
+    frequencies = CHIP_FLASH_FREQUENCIES.get(chip, FLASH_FREQUENCIES)
+    return ImageHeader(chip, chip_id, FLASH_MODES.get(mode, '0x%x' % mode), sizes.get(size_freq >> 4, '0x%x' % (size_freq >> 4)),
+                       frequencies.get(size_freq & 0xF, '0x%x' % (size_freq & 0xF)), entry, segments, offset, sha256)
+
+
+def bootloader_address(chip):
+    '''Address string the bootloader of chip goes at'''
+    return '0x%x' % BOOTLOADER_ADDRESSES.get(chip, DEFAULT_BOOTLOADER_ADDRESS)
+
+
+def header_of(image):
+    '''ImageHeader of a FirmwareImage, parsed once'''
+    if image.header is None:
+        image.header = parse_header(image.data, image.name)
+    return image.header
+
+
+def project_chip(images):
+    '''Chip the bootloader and app among [(address, FirmwareImage)] are built for, None without them
+
+    ValueError if one of them is corrupt or they are built for different chips.
+    '''
+    chip, source = None, None
+    for _, image in images:
+        if image.role not in HEADER_ROLES:
+            continue
+        header = header_of(image)
+        if chip is not None and header.chip != chip:
+            raise ValueError('%s is built for %s but %s for %s' % (source, chip, image.name, header.chip))
+        chip, source = header.chip, image.name
+    return chip
+
+
+def check_images(images, chip='auto'):
+    '''Raise ValueError unless the images suit chip ('auto' takes any) and the bootloader sits where the ROM looks'''
+    built_for = project_chip(images)
+    if built_for is None:
+        return
+    if chip != 'auto' and chip != built_for:
+        raise ValueError('the images are built for %s, not %s' % (built_for, chip))
+    expected = bootloader_address(built_for)
+    for address, image in images:
+        if image.role == 'bootloader' and int(address, 0) != int(expected, 0):
+            raise ValueError('the %s bootloader goes at %s, not %s' % (built_for, expected, address))
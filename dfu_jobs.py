@@ -0,0 +1,419 @@
+'''Persistent queue of board jobs and the scheduler running them. No wx here.
+
+Erase, flash, verify and read-back operations are queued as FlashJobs.
+The queue is a JSON file in the app data folder, next to the images the
+jobs write (kept by SHA-256), so it survives a restart: jobs that were
+running go back to the queue.
+
+The scheduler hands runnable jobs to worker threads, at most one per
+port, so the throughput grows with the number of boards attached. The
+highest priority goes first (rework boards before new ones), then the
+oldest. A failed job is queued again after a backoff that doubles with
+every attempt, until it runs out of attempts.
+'''
+import os
+import json
+import time
+import threading
+import dfu_core
+import dfu_cache
+import dfu_ports
+import dfu_metrics
+import dfu_monitor
+import dfu_project
+
+ERASE = 'erase'
+FLASH = 'flash'
+VERIFY = 'verify'
+READ = 'read'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+PRIORITY_NORMAL = 0
+PRIORITY_REWORK = 10
+
+MAX_ATTEMPTS = 3
+# seconds before the first retry, doubled for every attempt after it
+BACKOFF_S = 2.0
+MAX_BACKOFF_S = 60.0
+# finished jobs kept in the queue file for the record
+KEEP_FINISHED = 200
+
+
+class FlashJob:
+    '''One operation on one port; every attribute goes to the queue file as is'''
+    def __init__(self, kind, port, baud, chip, images=(), erase=False, smart=False, verify=False, regions=(),
+                 monitor=None, before='default_reset', after='hard_reset', priority=PRIORITY_NORMAL,
+                 max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_S):
+        self.id = None
+        self.kind = kind
+        # None to auto-detect the board when the job runs
+        self.port = port
+        self.baud = str(baud)
+        self.chip = chip
+        # [[address, name, role, sha256]] of the images to write or verify, see JobQueue.images()
+        self.images = [list(image) for image in images]
+        # True for a chip erase, or [[offset, size]] regions, erased before any write
+        self.erase = erase
+        self.smart = smart
+        # check the flash MD5 of every image again once a FLASH job wrote them all
+        self.verify = verify
+        # [[address, size, path]] of the flash a READ job streams to files
+        self.regions = [list(region) for region in regions]
+        # dfu_monitor.SerialMonitor keywords to watch the board boot after a FLASH job, or None
+        self.monitor = monitor
+        # result of that monitor, see dfu_monitor
+        self.self_test = None
+        self.before = before
+        self.after = after
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.state = QUEUED
+        self.attempts = 0
+        self.not_before = 0.0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['kind'], data['port'], data['baud'], data['chip'])
+        job.__dict__.update(data)
+        return job
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def describe(self):
+        return 'job %d (%s on %s)' % (self.id, self.kind, self.port or 'auto')
+
+
+class JobQueue:
+    '''FlashJobs and their images, saved in root (kept in memory only when root is None)
+
+    Every method takes the lock of `changed`, a Condition notified when a
+    job is added or finished.
+    '''
+    def __init__(self, root=None):
+        self.root = root
+        self.changed = threading.Condition()
+        self.jobs = []
+        # sha256 -> FirmwareImage of the jobs, loaded once
+        self.loaded = {}
+        self.next_id = 1
+        if root is not None:
+            os.makedirs(os.path.join(root, 'images'), exist_ok=True)
+            self.load()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.root, 'queue.json')) as file:
+                self.jobs = [FlashJob.from_dict(data) for data in json.load(file)]
+        except (OSError, ValueError, KeyError):
+            self.jobs = []
+        for job in self.jobs:
+            # the app stopped while these were running
+            if job.state == RUNNING:
+                job.state = QUEUED
+        self.next_id = max([job.id for job in self.jobs], default=0) + 1
+
+    def save(self):
+        if self.root is None:
+            return
+        path = os.path.join(self.root, 'queue.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump([job.as_dict() for job in self.jobs], file, indent=1)
+        os.replace(tmp, path)
+
+    def image_path(self, digest):
+        return os.path.join(self.root, 'images', digest + '.bin')
+
+    def submit(self, job, images=()):
+        '''Queue job, writing [(address, FirmwareImage)]. Returns the job id'''
+        with self.changed:
+            job.images = [[address, image.name, image.role, image.digest()] for address, image in images]
+            for _, image in images:
+                self.loaded[image.digest()] = image
+                if self.root is not None and not os.path.exists(self.image_path(image.digest())):
+                    dfu_cache.write_atomic(self.image_path(image.digest()), image.data)
+            job.id = self.next_id
+            self.next_id += 1
+            self.jobs.append(job)
+            self.save()
+            self.changed.notify_all()
+            return job.id
+
+    def images(self, job):
+        '''[(address, FirmwareImage)] of a job'''
+        with self.changed:
+            images = []
+            for address, name, role, digest in job.images:
+                if digest not in self.loaded:
+                    with open(self.image_path(digest), 'rb') as file:
+                        image = dfu_project.FirmwareImage(role, name, file.read())
+                    image.digests['sha256'] = digest
+                    self.loaded[digest] = image
+                images.append((address, self.loaded[digest]))
+            return images
+
+    def take(self, busy):
+        '''(job, None): the next job to run on a port not in busy, marked running.
+        (None, seconds) when there is none, seconds until one is due (None: no job waiting).
+        '''
+        with self.changed:
+            now = time.time()
+            waiting = [job for job in self.jobs if job.state == QUEUED and job.port not in busy]
+            due = [job for job in waiting if job.not_before <= now]
+            if not due:
+                return None, min([job.not_before - now for job in waiting], default=None)
+            job = max(due, key=lambda job: (job.priority, -job.id))
+            job.state = RUNNING
+            job.attempts += 1
+            self.save()
+            return job, None
+
+    def finish(self, job, ok):
+        '''Mark job done, or queue it again after its backoff while it has attempts left
+
+        A board that was flashed but failed its self-test is not flashed again.
+        '''
+        with self.changed:
+            if ok:
+                job.state = DONE
+                job.error = None
+            elif job.attempts < job.max_attempts and job.self_test is None:
+                job.state = QUEUED
+                job.not_before = time.time() + min(MAX_BACKOFF_S, job.backoff * 2 ** (job.attempts - 1))
+            else:
+                job.state = FAILED
+            if job.state != QUEUED:
+                job.finished = time.time()
+            self.prune()
+            self.save()
+            self.changed.notify_all()
+
+    def cancel(self, job_id=None):
+        '''Drop a queued job, or every queued job with no id. Returns how many were dropped'''
+        with self.changed:
+            dropped = [job for job in self.jobs if job.state == QUEUED and job_id in (None, job.id)]
+            self.jobs = [job for job in self.jobs if job not in dropped]
+            self.prune()
+            self.save()
+            return len(dropped)
+
+    def pending(self):
+        '''Jobs queued or running'''
+        with self.changed:
+            return [job for job in self.jobs if job.state in (QUEUED, RUNNING)]
+
+    def queued(self, port, kind):
+        '''Whether a job of kind is queued on port (None: the auto-detected board)'''
+        with self.changed:
+            return any(job.state == QUEUED and job.kind == kind and job.port == port for job in self.jobs)
+
+    def prune(self):
+        '''Forget the oldest finished jobs, and the images no pending job needs'''
+        finished = [job for job in self.jobs if job.state in (DONE, FAILED)]
+        drop = finished[:max(0, len(finished) - KEEP_FINISHED)]
+        self.jobs = [job for job in self.jobs if job not in drop]
+        needed = {image[3] for job in self.jobs if job.state in (QUEUED, RUNNING) for image in job.images}
+        for digest in list(self.loaded):
+            if digest not in needed:
+                del self.loaded[digest]
+        if self.root is not None:
+            for name in os.listdir(os.path.join(self.root, 'images')):
+                if name[:-len('.bin')] not in needed:
+                    try:
+                        os.remove(os.path.join(self.root, 'images', name))
+                    except OSError:
+                        pass
+
+
+class JobRunner:
+    '''Runs a FlashJob on the sessions of a dfu_device.SessionPool, returns True on success
+
+    An erase job followed by a flash queued on the same port leaves its
+    connection open, so the flash skips the reset, sync and stub upload;
+    otherwise the board is reset and the port released. Every run is timed and
+    appended to the job log like any other. Without a pool, one is made
+    (and esptool loaded) by the first job.
+
+    A flash job with monitor settings then watches the board boot on the
+    same worker, so the port stays busy meanwhile, as the 'monitor' stage of
+    the run: a failed self-test fails the job and its record.
+    on_monitor(monitor) is called when such a monitor starts.
+    '''
+    def __init__(self, queue, sessions=None, on_monitor=None):
+        self.queue = queue
+        self.sessions = sessions
+        self.on_monitor = on_monitor
+        self.lock = threading.Lock()
+
+    def pool(self):
+        with self.lock:
+            if self.sessions is None:
+                import dfu_device
+                self.sessions = dfu_device.SessionPool(dfu_core.baud_profiles(), dfu_core.checkpoints())
+            return self.sessions
+
+    def release(self, port, after=None):
+        '''Close the session of port, if any'''
+        if self.sessions is not None:
+            self.sessions.release(port, after)
+
+    def close_all(self, after=None):
+        if self.sessions is not None:
+            self.sessions.close_all(after)
+
+    def __call__(self, job, detect=None):
+        '''Run job; detect(job) returns the port of an auto-detected board (dfu_core.detect_port() by default)'''
+        record = dfu_metrics.JobRecord(job.port, job.baud)
+        port = job.port
+
+        def run():
+            nonlocal port
+            images = self.queue.images(job)
+            if port is None:
+                port = detect(job) if detect is not None else dfu_core.detect_port(job.chip)
+            session = self.pool().get(port, job.baud, job.chip, job.before, record)
+            port = session.port
+            if job.erase is True:
+                session.erase_flash()
+            elif job.erase:
+                session.erase_regions(job.erase)
+            if job.kind == FLASH:
+                session.write(images, job.smart)
+                if job.verify:
+                    session.verify(images)
+            elif job.kind == VERIFY:
+                session.verify(images)
+            elif job.kind == READ:
+                session.dump(job.regions)
+            if job.kind == ERASE and self.queue.queued(job.port, FLASH):
+                print('Board left in download mode for the next operation')
+            else:
+                self.sessions.release(port, job.after)
+            if job.kind == FLASH and job.monitor:
+                dfu_monitor.self_test(port, record.mac or port, job.monitor, record, self.on_monitor)
+
+        ok = dfu_core.record_job(record, dfu_core.run_guarded(run))
+        job.self_test = record.self_test
+        if not ok:
+            job.error = record.error or 'failed'
+            if port is not None:
+                self.release(port)
+            if job.port is None and port is not None and record.self_test is None:
+                # the cached chip may be stale, probe this adapter again next time
+                dfu_core.port_cache().put(dfu_ports.adapter_key(port), None)
+        return ok
+
+
+class JobScheduler:
+    '''Dispatcher thread handing queued jobs to worker threads, at most one per port
+
+    execute(job, detect) runs a job on its worker thread and returns True
+    on success (a JobRunner); detect is the scheduler's detect(), which
+    finds the board of an auto-detect job among the ports no other job
+    runs on. The output of each job is routed into a dfu_core.PortWorker
+    reporting to on_update, as ParallelFlasher does.
+    on_done(job) is called after every run, with job.state telling if it
+    is done, failed for good or queued again.
+    '''
+    def __init__(self, queue, execute, on_update=None, on_done=None):
+        self.queue = queue
+        self.execute = execute
+        self.on_update = on_update
+        self.on_done = on_done
+        # port -> running FlashJob, None for an auto-detect job until its board is found
+        self.busy = {}
+        # frozenset of the ports in busy, replaced with it, for readers that must not wait on the lock
+        self.ports = frozenset()
+        self.stopped = False
+        self.thread = None
+        self.stream = None
+
+    def start(self):
+        self.stream = dfu_core.install_routed_stdout()
+        self.thread = threading.Thread(target=self.dispatch, name='job-dispatcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.queue.changed:
+            self.stopped = True
+            self.queue.changed.notify_all()
+
+    def is_busy(self, port):
+        '''Whether a job runs on port (auto-detect jobs count once their board is found), without the queue lock'''
+        return port in self.ports
+
+    def detect(self, job):
+        '''Port of the board of auto-detect job, skipping the busy ports; job is moved onto it in busy'''
+        skipped = set()
+        while True:
+            with self.queue.changed:
+                skipped.update(port for port in self.busy if port is not None)
+            port = dfu_core.detect_port(job.chip, skipped)
+            with self.queue.changed:
+                # a job may have started there while probing
+                if port not in self.busy:
+                    del self.busy[self.port_of(job)]
+                    self.busy[port] = job
+                    self.ports = frozenset(self.busy)
+                    # another auto-detect job may start now
+                    self.queue.changed.notify_all()
+                    return port
+            skipped.add(port)
+
+    def port_of(self, job):
+        '''Key of a running job in busy, taken with the lock'''
+        return next(port for port, running in self.busy.items() if running is job)
+
+    def dispatch(self):
+        with self.queue.changed:
+            while not self.stopped:
+                job, wait = self.queue.take(self.busy)
+                if job is None:
+                    self.queue.changed.wait(wait)
+                    continue
+                self.busy[job.port] = job
+                self.ports = frozenset(self.busy)
+                threading.Thread(target=self.work, args=(job,), name='job-%d' % job.id, daemon=True).start()
+
+    def work(self, job):
+        worker = dfu_core.PortWorker(job.port or 'auto', self.on_update)
+        self.stream.route(worker)
+        worker.set_status(dfu_core.PortWorker.RUNNING)
+        try:
+            ok = self.execute(job, self.detect)
+        except Exception as e:
+            print('--- ERROR ---')
+            print(e)
+            job.error = str(e)
+            ok = False
+        finally:
+            worker.flush()
+            self.stream.unroute()
+        worker.set_status(dfu_core.PortWorker.DONE if ok else dfu_core.PortWorker.FAILED)
+
+        with self.queue.changed:
+            del self.busy[self.port_of(job)]
+            self.ports = frozenset(self.busy)
+            self.queue.finish(job, ok)
+        if self.on_done is not None:
+            self.on_done(job)
+
+    def join(self, timeout=None):
+        '''Wait until no job is queued or running, False on timeout'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.changed:
+            while self.queue.pending():
+                left = None if deadline is None else deadline - time.time()
+                if left is not None and left <= 0:
+                    return False
+                self.queue.changed.wait(left)
+            return True
@@ -0,0 +1,94 @@
+'''Per-stage timing of flash jobs, written as JSON lines to a rolling log. No wx here.
+
+Every job gets a JobRecord. The session code wraps each stage (connect,
+stub upload, baud change, erase, write, verify, reset...) in
+record.stage(name, nbytes), which measures its wall time and throughput.
+The finished record goes to the job log as one JSON object per line:
+
+    {"port": "COM3", "adapter": "10C4:EA60", "chip": "ESP32-D0WDQ6", "mac": "24:0a:c4:...", "baud": "921600",
+     "images": {"firmware_x.bin": "<sha256>"}, "verified": {"firmware_x.bin": "<md5>"}, "ok": true, "error": null,
+     "started": 1700000000.0, "seconds": 7.9,
+     "stages": [{"stage": "connect", "seconds": 0.61, "bytes": 0, "kbit_s": null}, ...]}
+'''
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+
+class JobRecord:
+    '''Timings and outcome of one job on one port'''
+    def __init__(self, port=None, baud=None):
+        self.port = port
+        # VID:PID of the USB adapter of the port, see dfu_ports.adapter_id()
+        self.adapter = None
+        self.baud = str(baud) if baud is not None else None
+        self.chip = None
+        self.mac = None
+        self.images = {}
+        # name -> flash MD5 read back by the verify stage
+        self.verified = {}
+        # result of the monitor run after the flash, see dfu_monitor
+        self.self_test = None
+        self.stages = []
+        self.ok = None
+        self.error = None
+        self.started = time.time()
+        self.seconds = None
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        '''Time the body as stage name, moving nbytes. A failing stage is kept, marked failed'''
+        entry = {'stage': name, 'seconds': None, 'bytes': nbytes, 'kbit_s': None}
+        self.stages.append(entry)
+        t = time.time()
+        try:
+            yield entry
+        except BaseException as e:
+            entry['failed'] = True
+            if self.error is None:
+                self.error = '%s: %s' % (name, e)
+            raise
+        finally:
+            entry['seconds'] = round(time.time() - t, 4)
+            if entry['bytes'] and entry['seconds']:
+                entry['kbit_s'] = round(entry['bytes'] * 8 / entry['seconds'] / 1000, 1)
+
+    def finish(self, ok):
+        self.ok = ok
+        if ok:
+            # stages that failed and were retried keep their 'failed' mark
+            self.error = None
+        self.seconds = round(time.time() - self.started, 4)
+        return self
+
+    def as_dict(self):
+        return {
+            'port': self.port, 'adapter': self.adapter, 'chip': self.chip, 'mac': self.mac, 'baud': self.baud,
+            'images': self.images, 'verified': self.verified,
+            'self_test': self.self_test, 'ok': self.ok, 'error': self.error,
+            'started': round(self.started, 3), 'seconds': self.seconds, 'stages': self.stages,
+        }
+
+    def summary(self):
+        '''One line of stage timings for the console'''
+        return ', '.join('%s %.2fs' % (entry['stage'], entry['seconds'] or 0) for entry in self.stages)
+
+
+class MetricsLog:
+    '''Append-only JSON lines file, rotated to <path>.1 past max_bytes'''
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record.as_dict()) + '\n'
+        with self.lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line)
@@ -0,0 +1,180 @@
+'''Serial monitor taking over a board's port after it is flashed. No wx here.
+
+Once the board is reset into its app it logs on the same port. A
+SerialMonitor reads it on a worker thread in large batches (a blocking
+read for the first byte, then everything the driver holds, up to
+READ_SIZE), so it keeps up with boards logging at 921600 baud and more.
+The text goes to a dfu_console.ConsoleBuffer: a ring of the last
+max_lines for display, polled by the UI like the main console, and the
+whole capture streamed to a log file per device.
+
+With a pass and/or fail pattern (regular expressions), the first line
+matching one of them ends the monitor with a verdict, as a self-test
+would report it. Otherwise it captures for its whole duration.
+'''
+import os
+import re
+import time
+import codecs
+import threading
+import dfu_core
+import dfu_console
+
+MONITOR_BAUD = 115200
+READ_SIZE = 64 * 1024
+# longest wait for the first byte of a batch, and so for stop() to be seen
+READ_TIMEOUT_S = 0.1
+MAX_LINES = 2000
+DURATION_S = 30.0
+
+PASSED = 'passed'
+FAILED = 'failed'
+# a pattern was given and nothing matched it in time
+TIMEOUT = 'timeout'
+# no pattern, the log was captured for the whole duration (or until stopped)
+CAPTURED = 'captured'
+
+
+def log_path(device):
+    '''Log file of one monitor run of device (a MAC address or port name), in the app data folder'''
+    directory = os.path.join(dfu_core.app_data_dir(), 'monitor')
+    os.makedirs(directory, exist_ok=True)
+    name = re.sub(r'[^\w.-]', '_', os.path.basename(device))
+    return os.path.join(directory, '%s_%s.log' % (name, time.strftime('%Y%m%d-%H%M%S')))
+
+
+def monitor_board(port, device, settings, on_start=None):
+    '''Monitor port with settings (SerialMonitor keywords) until it is done, logging to the file of device
+
+    on_start(monitor) is called before reading starts. Returns the monitor.
+    '''
+    monitor = SerialMonitor(port, log_path=log_path(device), **settings)
+    if on_start is not None:
+        on_start(monitor)
+    monitor.run()
+    print(monitor.describe())
+    return monitor
+
+
+def self_test(port, device, settings, job, on_start=None):
+    '''monitor_board() timed as the 'monitor' stage of JobRecord job, esptool.FatalError if the self-test fails
+
+    The result goes to job.self_test, so a failed self-test fails the job
+    record before it is written. Returns the monitor.
+    '''
+    import esptool
+    with job.stage('monitor'):
+        monitor = monitor_board(port, device, settings, on_start)
+        job.self_test = monitor.result
+        if not monitor.ok():
+            raise esptool.FatalError('self-test ' + monitor.result)
+    return monitor
+
+
+class SerialMonitor:
+    '''Reads one port until a verdict, the end of its duration or stop()
+
+    run() blocks, start() runs it on its own thread. on_result(monitor) is
+    called from the reading thread at the end, with result set to PASSED,
+    FAILED, TIMEOUT or CAPTURED (FAILED with error set if the port failed).
+    '''
+    def __init__(self, port, baud=MONITOR_BAUD, log_path=None, pass_pattern=None, fail_pattern=None,
+                 duration=DURATION_S, max_lines=MAX_LINES, on_result=None):
+        self.port = port
+        self.baud = int(baud)
+        self.log_path = log_path
+        self.buffer = dfu_console.ConsoleBuffer(max_lines, log_path)
+        self.pass_re = re.compile(pass_pattern) if pass_pattern else None
+        self.fail_re = re.compile(fail_pattern) if fail_pattern else None
+        self.duration = duration
+        self.on_result = on_result
+        self.result = None
+        self.error = None
+        # the line that gave the verdict
+        self.matched = None
+        self.bytes = 0
+        self.partial = ''
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='monitor-' + self.port, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def open(self):
+        import serial
+        port = serial.Serial()
+        port.port = self.port
+        port.baudrate = self.baud
+        port.timeout = READ_TIMEOUT_S
+        # opening must not pull EN or GPIO0 low through the auto-reset circuit
+        port.dtr = False
+        port.rts = False
+        port.open()
+        return port
+
+    def run(self):
+        import serial
+        t = time.time()
+        try:
+            port = self.open()
+        except (serial.SerialException, OSError) as e:
+            self.error = str(e)
+            return self.finish(FAILED)
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        try:
+            with port:
+                while self.result is None and not self.stopped.is_set() and time.time() - t < self.duration:
+                    data = port.read(1)
+                    if not data:
+                        continue
+                    data += port.read(min(port.in_waiting, READ_SIZE))
+                    self.bytes += len(data)
+                    self.feed(decoder.decode(data))
+        except (serial.SerialException, OSError) as e:
+            self.error = str(e)
+            return self.finish(FAILED)
+        if self.result is None:
+            self.finish(TIMEOUT if self.pass_re or self.fail_re else CAPTURED)
+        else:
+            self.finish(self.result)
+
+    def feed(self, text):
+        '''Add a batch of text to the buffer, and look for a verdict in the lines it completes'''
+        self.buffer.write(text)
+        if self.pass_re is None and self.fail_re is None:
+            return
+        *lines, self.partial = (self.partial + text).split('\n')
+        for line in lines:
+            line = line.rstrip('\r')
+            if self.fail_re is not None and self.fail_re.search(line):
+                self.result, self.matched = FAILED, line
+                return
+            if self.pass_re is not None and self.pass_re.search(line):
+                self.result, self.matched = PASSED, line
+                return
+
+    def finish(self, result):
+        self.result = result
+        self.buffer.write('\n' if self.buffer.current else '')
+        self.buffer.close()
+        if self.on_result is not None:
+            self.on_result(self)
+
+    def ok(self):
+        return self.result in (PASSED, CAPTURED)
+
+    def describe(self):
+        '''One line about the outcome, for the console'''
+        text = 'Monitor on %s: %s, %d bytes' % (self.port, self.result, self.bytes)
+        if self.matched is not None:
+            text += ' (%s)' % self.matched.strip()
+        if self.error is not None:
+            text += ' (%s)' % self.error
+        if self.log_path:
+            text += ', log in ' + self.log_path
+        return text
@@ -0,0 +1,159 @@
+'''ESP partition table parsing and flash region planning. No wx here.
+
+The binary partition table (partitions_*.bin) gives the offsets the app
+and the filesystem image go to. The images to flash are checked against
+each other and against the table before any serial traffic, and a
+targeted erase only covers the sectors the images will use plus the
+partitions asked for by name, instead of the whole chip.
+'''
+import os
+import struct
+
+SECTOR_SIZE = 0x1000
+
+ENTRY_SIZE = 32
+ENTRY_MAGIC = 0x50AA
+MD5_MAGIC = 0xEBEB
+MAX_TABLE_SIZE = 0xC00
+
+TYPE_APP = 0x00
+TYPE_DATA = 0x01
+
+TYPES = {TYPE_APP: 'app', TYPE_DATA: 'data'}
+APP_SUBTYPES = dict([(0x00, 'factory'), (0x20, 'test')] + [(0x10 + n, 'ota_%d' % n) for n in range(16)])
+DATA_SUBTYPES = {0x00: 'ota', 0x01: 'phy', 0x02: 'nvs', 0x03: 'coredump', 0x04: 'nvs_keys', 0x05: 'efuse',
+                 0x80: 'esphttpd', 0x81: 'fat', 0x82: 'spiffs', 0x83: 'littlefs'}
+FILESYSTEM_SUBTYPES = (0x82, 0x83, 0x81)
+
+
+class Partition:
+    '''One entry of a partition table'''
+    def __init__(self, label, type, subtype, offset, size, flags=0):
+        self.label = label
+        self.type = type
+        self.subtype = subtype
+        self.offset = offset
+        self.size = size
+        self.flags = flags
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    def type_name(self):
+        return TYPES.get(self.type, '0x%02x' % self.type)
+
+    def subtype_name(self):
+        names = APP_SUBTYPES if self.type == TYPE_APP else DATA_SUBTYPES if self.type == TYPE_DATA else {}
+        return names.get(self.subtype, '0x%02x' % self.subtype)
+
+    def __repr__(self):
+        return '%-16s %-5s %-9s 0x%06x 0x%06x' % (self.label, self.type_name(), self.subtype_name(), self.offset, self.size)
+
+
+def parse_partitions(data):
+    '''[Partition] of a binary partition table, ValueError if it isn't one'''
+    partitions = []
+    for offset in range(0, min(len(data), MAX_TABLE_SIZE), ENTRY_SIZE):
+        entry = data[offset:offset + ENTRY_SIZE]
+        if len(entry) < ENTRY_SIZE or entry == b'\xff' * ENTRY_SIZE:
+            break
+        magic, type, subtype, part_offset, size, label, flags = struct.unpack('<HBBII16sI', entry)
+        if magic == MD5_MAGIC:
+            break
+        if magic != ENTRY_MAGIC:
+            raise ValueError('not a partition table (bad entry at 0x%x)' % offset)
+        partitions.append(Partition(label.rstrip(b'\x00').decode('ascii', 'replace'), type, subtype, part_offset, size, flags))
+    if not partitions:
+        raise ValueError('empty partition table')
+    return partitions
+
+
+def find_partition(partitions, label):
+    for partition in partitions:
+        if partition.label == label:
+            return partition
+    return None
+
+
+def role_addresses(partitions):
+    '''{role: address} derived from the table: the factory (or first OTA) app and the first filesystem'''
+    addresses = {}
+    apps = [partition for partition in partitions if partition.type == TYPE_APP]
+    apps.sort(key=lambda partition: (partition.subtype != 0x00, partition.offset))
+    if apps:
+        addresses['app'] = '0x%x' % apps[0].offset
+    for subtype in FILESYSTEM_SUBTYPES:
+        filesystems = [partition for partition in partitions if partition.type == TYPE_DATA and partition.subtype == subtype]
+        if filesystems:
+            addresses['spiffs'] = '0x%x' % filesystems[0].offset
+            break
+    return addresses
+
+
+def dump_regions(partitions, directory):
+    '''[(offset, size, path)] reading every partition to its own file in directory'''
+    return [(partition.offset, partition.size, os.path.join(directory, '%s_0x%x.bin' % (partition.label, partition.offset)))
+            for partition in partitions]
+
+
+def partitions_of(images):
+    '''Parsed partition table among [(address, FirmwareImage)], or None'''
+    for _, image in images:
+        if image.role == 'partitions':
+            return parse_partitions(image.data)
+    return None
+
+
+def extents(images):
+    '''[(start, end, name)] of [(address, FirmwareImage)], sorted, ValueError on a bad address'''
+    spans = []
+    for address, image in images:
+        try:
+            start = int(address, 0)
+        except ValueError:
+            raise ValueError('bad address %r for %s' % (address, image.name))
+        spans.append((start, start + len(image), image.name))
+    spans.sort()
+    return spans
+
+
+def check_images(images, partitions=None):
+    '''Raise ValueError if images overlap, or don't fit the partition they start in'''
+    spans = extents(images)
+    for (start, end, name), (next_start, _, next_name) in zip(spans, spans[1:]):
+        if next_start < end:
+            raise ValueError('%s (0x%x-0x%x) overlaps %s at 0x%x' % (name, start, end, next_name, next_start))
+    for start, end, name in spans:
+        for partition in partitions or ():
+            if partition.offset <= start < partition.end and end > partition.end:
+                raise ValueError('%s (%d bytes) does not fit in partition %s at 0x%x (%d bytes)'
+                                 % (name, end - start, partition.label, partition.offset, partition.end - start))
+
+
+def merge_regions(regions):
+    '''Sector aligned, sorted and merged [(offset, size)]'''
+    spans = []
+    for offset, size in regions:
+        start = offset - offset % SECTOR_SIZE
+        end = offset + size + (-(offset + size) % SECTOR_SIZE)
+        spans.append([start, end])
+    spans.sort()
+    merged = []
+    for start, end in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end - start) for start, end in merged]
+
+
+def erase_plan(images, partitions=None, labels=()):
+    '''Regions [(offset, size)] to erase: what images will cover plus the partitions named in labels'''
+    regions = [(start, end - start) for start, end, _ in extents(images)]
+    for label in labels:
+        partition = find_partition(partitions or (), label)
+        if partition is None:
+            raise ValueError('no partition named %r in the partition table' % label)
+        regions.append((partition.offset, partition.size))
+    return merge_regions(regions)
@@ -0,0 +1,215 @@
+'''Serial port listing and fast ESP auto-detection. No wx here.
+
+Ports are ranked by their USB bridge: the adapters found on ESP boards come
+first, other USB serial devices next, and ports without USB ids (legacy COM
+ports, Bluetooth) last. Detection first looks the present adapters up in
+a port -> chip cache. Otherwise it probes every candidate at the same
+time with a single short sync, instead of esptool's one-after-the-other
+reset and sync of every port. PortWatcher reports ports as they are
+plugged in and out. pyserial and esptool are imported on first use.
+'''
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+# USB bridges found on ESP boards, by (VID, PID)
+BRIDGES = {
+    (0x10C4, 0xEA60): 'CP210x',
+    (0x10C4, 0xEA70): 'CP2105',
+    (0x1A86, 0x7523): 'CH340',
+    (0x1A86, 0x55D4): 'CH9102',
+    (0x0403, 0x6001): 'FTDI',
+    (0x0403, 0x6010): 'FTDI',
+    (0x0403, 0x6014): 'FTDI',
+    (0x0403, 0x6015): 'FTDI',
+    (0x303A, 0x1001): 'USB-JTAG',
+    (0x303A, 0x0002): 'USB-CDC',
+}
+
+DETECT_TIMEOUT = 3.0
+# seconds between two looks at the port list
+WATCH_INTERVAL = 1.0
+
+
+class PortInfo:
+    '''A serial port and what the OS tells about its adapter'''
+    def __init__(self, info):
+        self.device = info.device
+        self.description = info.description
+        self.vid = info.vid
+        self.pid = info.pid
+        self.serial_number = info.serial_number
+        self.bridge = BRIDGES.get((info.vid, info.pid))
+
+    @property
+    def key(self):
+        '''VID:PID:serial of the USB adapter, or the port name for anything else'''
+        if self.vid is None:
+            return self.device
+        return '%04X:%04X:%s' % (self.vid, self.pid, self.serial_number or '')
+
+    def rank(self):
+        if self.bridge:
+            return 0
+        return 1 if self.vid is not None else 2
+
+    def label(self):
+        return '%s (%s)' % (self.device, self.bridge or self.description)
+
+
+def list_ports():
+    '''[PortInfo] of every serial port, ESP bridges first, then by name'''
+    import serial.tools.list_ports
+    ports = [PortInfo(info) for info in serial.tools.list_ports.comports()]
+    ports.sort(key=lambda port: (port.rank(), port.device))
+    return ports
+
+
+def adapter_key(port):
+    '''PortInfo.key of a port name'''
+    for info in list_ports():
+        if info.device == port:
+            return info.key
+    return port
+
+
+def adapter_id(port):
+    '''VID:PID of the USB adapter of a port name, None for anything else'''
+    for info in list_ports():
+        if info.device == port and info.vid is not None:
+            return '%04X:%04X' % (info.vid, info.pid)
+    return None
+
+
+def chip_matches(chip, name):
+    '''Whether the chip chosen by the user ('auto', 'esp32s3'...) accepts esptool's CHIP_NAME'''
+    return chip == 'auto' or chip == name.lower().replace('-', '')
+
+
+def probe(port):
+    '''CHIP_NAME of the ESP answering on port after one reset and sync, or None'''
+    import serial
+    import esptool
+    try:
+        esp = esptool.cmds.detect_chip(port, esptool.ESPLoader.ESP_ROM_BAUD, 'default_reset', connect_attempts=1)
+    except (esptool.FatalError, serial.SerialException, OSError):
+        return None
+    try:
+        return esp.CHIP_NAME
+    finally:
+        esp._port.close()
+
+
+class PortChipCache:
+    '''Chip last found behind every adapter, kept in a JSON file'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.chips = json.load(file)
+        except (OSError, ValueError):
+            self.chips = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.chips.get(key)
+
+    def put(self, key, chip):
+        with self.lock:
+            if self.chips.get(key) == chip:
+                return
+            if chip is None:
+                self.chips.pop(key, None)
+            else:
+                self.chips[key] = chip
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as file:
+                json.dump(self.chips, file, indent=1)
+            os.replace(tmp, self.path)
+
+
+def detect(chip='auto', cache=None, timeout=DETECT_TIMEOUT, exclude=()):
+    '''Port of an ESP matching chip, or None. The ports in exclude (busy with another job) are left alone
+
+    A present adapter known to the cache is returned without touching it,
+    the connection that follows checks it anyway. Otherwise the USB ports
+    (every port if there is none) are probed concurrently and the first
+    matching answer wins. The probes not started yet are cancelled and the
+    running ones waited for, so none still holds a port (or resets its
+    board) when the caller opens it; they fill the cache for next time.
+    '''
+    ports = [port for port in list_ports() if port.device not in exclude]
+    candidates = [port for port in ports if port.vid is not None] or ports
+    if cache is not None:
+        for port in candidates:
+            name = cache.get(port.key)
+            if name and chip_matches(chip, name):
+                print('Found %s on %s (known adapter)' % (name, port.label()))
+                return port.device
+    if not candidates:
+        return None
+
+    print('Probing %d ports...' % len(candidates))
+
+    def run(port):
+        name = probe(port.device)
+        if cache is not None:
+            cache.put(port.key, name)
+        return port, name
+
+    pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix='probe')
+    futures = [pool.submit(run, port) for port in candidates]
+    found = None
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            port, name = future.result()
+            if name and chip_matches(chip, name):
+                print('Found %s on %s' % (name, port.label()))
+                found = port.device
+                break
+    except TimeoutError:
+        pass
+    pool.shutdown(wait=True, cancel_futures=True)
+    return found
+
+
+class PortWatcher:
+    '''Background thread calling on_change(added, removed) when the set of ports changes
+
+    added is a list of PortInfo, removed a list of port names. pyserial has
+    no portable arrival notification, so the port list is polled; listing
+    ports is cheap next to a flash and only differences are reported.
+    '''
+    def __init__(self, on_change, interval=WATCH_INTERVAL):
+        self.on_change = on_change
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='port-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        # None until the first listing, which is not reported
+        known = None
+        while True:
+            try:
+                ports = list_ports()
+            except OSError:
+                ports = None
+            if ports is not None:
+                devices = {port.device for port in ports}
+                if known is not None:
+                    added = [port for port in ports if port.device not in known]
+                    removed = sorted(known - devices)
+                    if added or removed:
+                        self.on_change(added, removed)
+                known = devices
+            if self.stopped.wait(self.interval):
+                return
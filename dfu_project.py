@@ -0,0 +1,152 @@
+'''Release zip handling shared by the GUI and the command line. No wx here.
+
+Images are kept in memory: a zip is indexed from its central directory and
+only the members that match an image role are ever decompressed.
+'''
+import re
+import zlib
+import fnmatch
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# flash order, file name pattern inside the zip and default address of every image
+ROLES = [
+    ('bootloader', 'bootloader_*.bin', '0x1000'),
+    ('partitions', 'partitions_*.bin', '0x8000'),
+    ('app', 'firmware_*.bin', '0x10000'),
+    ('spiffs', 'spiffs_*.bin', '0x290000'),
+]
+
+DEFAULT_ADDRESSES = {role: address for role, _, address in ROLES}
+
+# digests kept for every image: md5 is what the flash stub computes, sha256 names it
+DIGESTS = ('md5', 'sha256')
+HASH_WORKERS = 4
+
+ROLE_MATCHERS = [(role, re.compile(fnmatch.translate(pattern))) for role, pattern, _ in ROLES]
+
+
+def match_role(name):
+    '''Role of a file name (top level of the zip only), or None'''
+    if '/' in name:
+        return None
+    for role, matcher in ROLE_MATCHERS:
+        if matcher.match(name):
+            return role
+    return None
+
+
+class FirmwareImage:
+    '''One image to flash, held in memory'''
+    def __init__(self, role, name, data):
+        self.role = role
+        self.name = name
+        self.data = data
+        self.digests = {}
+        self.blocks = {}
+        self.erased = {}
+        # dfu_header.ImageHeader of a bootloader or app image, see dfu_header.header_of()
+        self.header = None
+        # (zip digest, role) when the image lives in the firmware cache
+        self.cache_key = None
+        # zlib stream written by every device, and its FLASH_DEFL_DATA blocks by block size
+        self.compressed = None
+        self.deflate_blocks = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, role, path):
+        with open(path, 'rb') as file:
+            return cls(role, path, file.read())
+
+    def __len__(self):
+        return len(self.data)
+
+    def digest(self, name='sha256'):
+        '''Hex digest of the image, computed once'''
+        if name not in self.digests:
+            self.digests[name] = hashlib.new(name, self.data).hexdigest()
+        return self.digests[name]
+
+    def block_md5s(self, block_size):
+        '''MD5 of every block_size slice of the image (the last one may be short), computed once'''
+        if block_size not in self.blocks:
+            view = memoryview(self.data)
+            self.blocks[block_size] = [hashlib.md5(view[offset:offset + block_size]).hexdigest()
+                                       for offset in range(0, len(self.data), block_size)]
+        return self.blocks[block_size]
+
+    def erased_runs(self, sector_size):
+        '''[(start, end)] of the runs of whole sectors holding only 0xFF (the last one may be short), computed once'''
+        if sector_size not in self.erased:
+            view = memoryview(self.data)
+            blank = b'\xff' * sector_size
+            runs = []
+            for offset in range(0, len(self.data), sector_size):
+                end = min(offset + sector_size, len(self.data))
+                if view[offset:end] != blank[:end - offset]:
+                    continue
+                if runs and runs[-1][1] == offset:
+                    runs[-1][1] = end
+                else:
+                    runs.append([offset, end])
+            self.erased[sector_size] = [tuple(run) for run in runs]
+        return self.erased[sector_size]
+
+    def deflated(self):
+        '''The image padded like esptool does and zlib compressed, once for every board and worker'''
+        with self.lock:
+            if self.compressed is None:
+                self.compressed = zlib.compress(self.data + b'\xff' * (-len(self.data) % 4), 9)
+            return self.compressed
+
+
+class ProjectIndex:
+    '''Role to member map of a release zip, built from its central directory in one pass'''
+    def __init__(self, zip_path):
+        from zipfile import ZipFile
+        self.zip_path = zip_path
+        self.members = {}
+        with ZipFile(zip_path, 'r') as zip:
+            for info in zip.infolist():
+                role = match_role(info.filename)
+                # the first match wins, as the directory glob used to
+                if role is not None and role not in self.members:
+                    self.members[role] = info
+
+    def load(self, roles=None):
+        '''Decompress the matched images (or only `roles`) and return {role: FirmwareImage}'''
+        from zipfile import ZipFile
+        images = {}
+        with ZipFile(self.zip_path, 'r') as zip:
+            for role, info in self.members.items():
+                if roles is None or role in roles:
+                    images[role] = FirmwareImage(role, info.filename, zip.read(info))
+        return images
+
+    def printdir(self):
+        for role, _, _ in ROLES:
+            if role in self.members:
+                info = self.members[role]
+                print('%-12s %-40s %10d' % (role, info.filename, info.file_size))
+
+
+def hash_images(images, names=DIGESTS):
+    '''Compute every digest of every FirmwareImage, in parallel, those already known are skipped
+
+    hashlib lets go of the GIL on large buffers, so the threads do run at once.
+    '''
+    todo = [(image, name) for image in images for name in names if name not in image.digests]
+    if not todo:
+        return
+    with ThreadPoolExecutor(max_workers=min(HASH_WORKERS, len(todo))) as pool:
+        list(pool.map(lambda pair: pair[0].digest(pair[1]), todo))
+
+
+def load_project(zip_path):
+    '''Index a release zip and return {role: FirmwareImage} of the images found'''
+    print("Open zip file...")
+    index = ProjectIndex(zip_path)
+    index.printdir()
+    return index.load()
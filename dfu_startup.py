@@ -0,0 +1,85 @@
+'''Launch timing of the GUI, from process creation to the first idle event loop. No wx here.
+
+doayee_dfu.py imports this module before anything else and marks the end
+of its imports, of the frame construction and the moment the event loop
+first runs (time-to-interactive). The phases are printed on the console
+and appended to startup.jsonl in the app data folder:
+
+    {"started": 1700000000.0, "frozen": true, "phases": {"unpack": 1.92,
+     "interpreter": 0.31, "imports": 0.44, "frame": 0.21, "ready": 0.05}, "total": 2.93}
+
+"interpreter" runs from process creation to the first line of the app,
+and "unpack" (PyInstaller one-file builds) from the launch of the
+bootloader process that unpacks the bundle to the start of this one.
+Both are left out where the OS doesn't tell when a process started.
+Only the standard library is used here, to keep it out of the timings.
+'''
+import os
+import sys
+import time
+
+
+def process_created(pid):
+    '''Epoch time process pid was created, or None where it can't be found out'''
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            from ctypes import wintypes
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+            if not handle:
+                return None
+            try:
+                times = [wintypes.FILETIME() for _ in range(4)]
+                if not kernel32.GetProcessTimes(handle, *[ctypes.byref(t) for t in times]):
+                    return None
+                created = times[0].dwHighDateTime << 32 | times[0].dwLowDateTime
+                # 100 ns ticks since 1601
+                return created / 1e7 - 11644473600
+            finally:
+                kernel32.CloseHandle(handle)
+        if os.path.exists('/proc/%d/stat' % pid):
+            with open('/proc/%d/stat' % pid) as file:
+                # the command name may hold spaces, the fields after it don't
+                ticks = int(file.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime') as file:
+                uptime = float(file.read().split()[0])
+            return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    return None
+
+
+class StartupTimer:
+    '''Time marks of one launch, see the module docstring'''
+    def __init__(self):
+        self.started = time.time()
+        self.frozen = getattr(sys, 'frozen', False)
+        self.created = process_created(os.getpid())
+        self.launched = process_created(os.getppid()) if self.frozen else None
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.time()))
+
+    def phases(self):
+        '''[(name, seconds)] in launch order'''
+        phases = []
+        if self.launched is not None and self.created is not None:
+            phases.append(('unpack', self.created - self.launched))
+        if self.created is not None:
+            phases.append(('interpreter', self.started - self.created))
+        last = self.started
+        for name, t in self.marks:
+            phases.append((name, t - last))
+            last = t
+        return phases
+
+    def as_dict(self):
+        phases = self.phases()
+        return {'started': round(self.started, 3), 'frozen': self.frozen,
+                'phases': {name: round(seconds, 4) for name, seconds in phases},
+                'total': round(sum(seconds for _, seconds in phases), 4)}
+
+    def summary(self):
+        return ', '.join('%s %.2fs' % phase for phase in self.phases())
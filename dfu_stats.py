@@ -0,0 +1,204 @@
+'''Production statistics of flash jobs in an SQLite database. No wx here.
+
+Every finished JobRecord is added to a StatsStore (see dfu_core.record_job),
+which writes them from its own thread, many per transaction, so neither
+the UI nor the flash workers wait on the disk. The first time the
+database is created, the job log (jobs.jsonl) is imported into it.
+
+    jobs    one row per job: when, how long, port, adapter VID:PID, chip,
+            MAC, baud, outcome
+    stages  the timed stages of every job, a 'failed' one was retried or
+            ended the job
+    images  name and SHA-256 of the images every job wrote
+
+report() answers the production questions from there: boards per hour,
+latency percentiles of every stage, failures (retried or not) per stage,
+and failure counts by port, adapter, chip and firmware.
+'''
+import os
+import json
+import math
+import time
+import queue
+import sqlite3
+import threading
+
+# records written per transaction at most, and the longest they wait
+BATCH_SIZE = 200
+FLUSH_S = 1.0
+REPORT_HOURS = 24.0
+PERCENTILES = (50, 90, 99)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY, started REAL, seconds REAL, port TEXT, adapter TEXT, chip TEXT, mac TEXT,
+    baud TEXT, ok INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS stages (job_id INTEGER, stage TEXT, seconds REAL, bytes INTEGER, failed INTEGER);
+CREATE TABLE IF NOT EXISTS images (job_id INTEGER, name TEXT, sha256 TEXT);
+CREATE INDEX IF NOT EXISTS jobs_started ON jobs (started);
+CREATE INDEX IF NOT EXISTS stages_job ON stages (job_id);
+CREATE INDEX IF NOT EXISTS images_job ON images (job_id);
+CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+'''
+
+# failure counts of report(), by column of the jobs (or images) table
+GROUPS = [('port', 'jobs.port'), ('adapter', 'jobs.adapter'), ('chip', 'jobs.chip'), ('firmware', 'images.sha256')]
+
+
+def percentile(values, p):
+    '''p-th percentile of sorted values, nearest rank'''
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class StatsStore:
+    '''SQLite database of job records at path, written in batches by a thread of its own'''
+    def __init__(self, path, import_log=None):
+        self.path = path
+        # JSON lines job log imported when the database is new, up to where it
+        # ends now: the records appended after it come through add()
+        self.import_log = import_log
+        try:
+            self.import_size = os.path.getsize(import_log) if import_log else 0
+        except OSError:
+            self.import_size = 0
+        self.pending = queue.Queue()
+        self.thread = None
+        # guards the writer thread start and the setup of the database
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def connect(self):
+        '''A connection to the database; the first one creates its tables, and imports the job log if it is new'''
+        with self.lock:
+            new = not self.ready and not os.path.exists(self.path)
+            db = sqlite3.connect(self.path)
+            if not self.ready:
+                db.executescript(SCHEMA)
+                if new and self.import_log:
+                    self.write(db, self.read_log(self.import_log, self.import_size))
+                self.ready = True
+        return db
+
+    def add(self, record):
+        '''Queue a finished dfu_metrics.JobRecord (or its as_dict()) for writing'''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='stats-writer', daemon=True)
+                self.thread.start()
+        self.pending.put(record if isinstance(record, dict) else record.as_dict())
+
+    def flush(self):
+        '''Wait until every record added so far is written'''
+        if self.thread is not None:
+            # None tells the writer not to wait for more records
+            self.pending.put(None)
+            self.pending.join()
+
+    def run(self):
+        db = self.connect()
+        while True:
+            items = [self.pending.get()]
+            deadline = time.time() + FLUSH_S
+            while len(items) < BATCH_SIZE and items[-1] is not None:
+                try:
+                    items.append(self.pending.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            try:
+                self.write(db, [item for item in items if item is not None])
+            except sqlite3.Error as e:
+                print('could not write the stats: ' + str(e))
+            for _ in items:
+                self.pending.task_done()
+
+    def read_log(self, path, size):
+        '''Records of a JSON lines job log (its first size bytes) and its rotated part, oldest first'''
+        records = []
+        for name, limit in ((path + '.1', None), (path, size)):
+            try:
+                with open(name, 'rb') as file:
+                    for line in file.read(limit).decode('utf-8', 'replace').splitlines():
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            pass
+            except OSError:
+                pass
+        return records
+
+    def write(self, db, records):
+        '''Insert records (JobRecord.as_dict()) in one transaction'''
+        with db:
+            for record in records:
+                cursor = db.execute(
+                    'INSERT INTO jobs (started, seconds, port, adapter, chip, mac, baud, ok, error) VALUES (?,?,?,?,?,?,?,?,?)',
+                    (record.get('started'), record.get('seconds'), record.get('port'), record.get('adapter'),
+                     record.get('chip'), record.get('mac'), record.get('baud'), int(bool(record.get('ok'))),
+                     record.get('error')))
+                job_id = cursor.lastrowid
+                db.executemany('INSERT INTO stages (job_id, stage, seconds, bytes, failed) VALUES (?,?,?,?,?)',
+                               [(job_id, stage['stage'], stage['seconds'], stage['bytes'], int(stage.get('failed', False)))
+                                for stage in record.get('stages', ())])
+                db.executemany('INSERT INTO images (job_id, name, sha256) VALUES (?,?,?)',
+                               [(job_id, name, sha256) for name, sha256 in record.get('images', {}).items()])
+
+    def report(self, hours=REPORT_HOURS, now=None):
+        '''Statistics of the jobs started in the last hours, as a dict (see format_report())'''
+        self.flush()
+        now = now or time.time()
+        since = now - hours * 3600
+        db = self.connect()
+        try:
+            jobs, ok, first = db.execute('SELECT COUNT(*), TOTAL(ok), MIN(started) FROM jobs WHERE started >= ?',
+                                         (since,)).fetchone()
+            last_hour = db.execute('SELECT TOTAL(ok) FROM jobs WHERE started >= ?', (now - 3600,)).fetchone()[0]
+
+            durations = {}
+            failed_stages = {}
+            for stage, seconds, failed in db.execute(
+                    'SELECT stages.stage, stages.seconds, stages.failed FROM stages JOIN jobs ON jobs.id = stages.job_id '
+                    'WHERE jobs.started >= ? ORDER BY stages.stage, stages.seconds', (since,)):
+                if not failed and seconds is not None:
+                    durations.setdefault(stage, []).append(seconds)
+                failed_stages[stage] = failed_stages.get(stage, 0) + failed
+            stages = [{'stage': stage, 'count': len(values), 'failed': failed_stages.get(stage, 0),
+                       'percentiles': {p: percentile(values, p) for p in PERCENTILES}}
+                      for stage, values in sorted(durations.items())]
+            stages += [{'stage': stage, 'count': 0, 'failed': count, 'percentiles': {}}
+                       for stage, count in sorted(failed_stages.items()) if stage not in durations]
+
+            failures = {}
+            for name, column in GROUPS:
+                join = 'JOIN images ON images.job_id = jobs.id ' if column.startswith('images') else ''
+                failures[name] = db.execute(
+                    'SELECT %s, COUNT(*), COUNT(*) - TOTAL(ok) FROM jobs %sWHERE started >= ? GROUP BY %s '
+                    'ORDER BY 3 DESC, 2 DESC' % (column, join, column), (since,)).fetchall()
+        finally:
+            db.close()
+        span = (now - first) / 3600 if first is not None else 0
+        return {'hours': hours, 'jobs': jobs, 'ok': int(ok), 'failed': jobs - int(ok),
+                'boards_per_hour': ok / min(hours, max(span, 1)) if jobs else 0.0,
+                'last_hour': int(last_hour), 'stages': stages, 'failures': failures}
+
+
+def format_report(report):
+    '''Lines of text of a StatsStore.report()'''
+    lines = ['Last %g hours: %d jobs, %d ok, %d failed (%.1f %%), %.1f boards per hour, %d in the last hour'
+             % (report['hours'], report['jobs'], report['ok'], report['failed'],
+                100.0 * report['failed'] / report['jobs'] if report['jobs'] else 0,
+                report['boards_per_hour'], report['last_hour'])]
+    if report['stages']:
+        lines.append('%-10s %6s %8s %8s %8s %8s' % (('stage', 'count') + tuple('p%d s' % p for p in PERCENTILES) + ('failed',)))
+        for stage in report['stages']:
+            times = ['%8.2f' % stage['percentiles'][p] if stage['percentiles'].get(p) is not None else '%8s' % '-'
+                     for p in PERCENTILES]
+            lines.append('%-10s %6d %s %8d' % (stage['stage'], stage['count'], ' '.join(times), stage['failed']))
+    for name, rows in report['failures'].items():
+        rows = [row for row in rows if row[2]]
+        if rows:
+            lines.append('failures by %s: ' % name + ', '.join(
+                '%s %d/%d' % ('-' if key is None else key[:12] if name == 'firmware' else key, failed, count)
+                for key, count, failed in rows))
+    return lines
@@ -0,0 +1,57 @@
+'''Background execution of the GUI's blocking work. No wx here.
+
+Event handlers never touch a serial port or the disk themselves: they hand
+the work to a TaskRunner and give it the callbacks that use the result.
+The work runs on a pool of threads; results, errors and any other update
+meant for the window go back through post(), the one dispatcher given to
+the runner (wx.CallAfter in the GUI), so callbacks run on the UI thread,
+one at a time, in the order they were posted.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 8
+
+
+class TaskRunner:
+    '''Runs functions on worker threads and posts their outcome to the UI thread'''
+    def __init__(self, post, max_workers=MAX_WORKERS):
+        self.post = post
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        # names of the tasks running, see run()
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def run(self, func, *args, on_done=None, on_error=None, name=None):
+        '''Call func(*args) on a worker thread, then post on_done(result) or on_error(exception)
+
+        Errors are printed when there is no on_error. A task given a name
+        is not started again while it runs (a double click), None is
+        returned then, the Future of the task otherwise.
+        '''
+        if name is not None:
+            with self.lock:
+                if name in self.running:
+                    print(name + ': already running')
+                    return None
+                self.running.add(name)
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(lambda future: self.finish(future, name, on_done, on_error))
+        return future
+
+    def finish(self, future, name, on_done, on_error):
+        if name is not None:
+            with self.lock:
+                self.running.discard(name)
+        error = future.exception()
+        if error is not None:
+            self.post(on_error or self.report, error)
+        elif on_done is not None:
+            self.post(on_done, future.result())
+
+    def report(self, error):
+        print('--- ERROR ---')
+        print(error)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
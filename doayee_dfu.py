@@ -1,42 +1,55 @@
+# first, so the launch is timed from here
+import dfu_startup
+STARTUP = dfu_startup.StartupTimer()
+
+# esptool and pyserial are left to the first operation that needs them
 import wx
 import sys
-import threading
-import serial
-import serial.tools.list_ports
 import time
 import os
-import esptool
-import tempfile
-from zipfile import ZipFile
-import pathlib
-import shutil
+import re
+import dfu_core
+import dfu_project
+import dfu_console
+import dfu_cache
+import dfu_baud
+import dfu_ports
+import dfu_partitions
+import dfu_header
+import dfu_jobs
+import dfu_tasks
+import dfu_metrics
+import dfu_monitor
+
+STARTUP.mark('imports')
 
 VERSION = 'V1.6'
 
+DEFAULT_BAUD = '921600'
+
+# console keeps this many lines on screen, the full log goes to CONSOLE_LOG_FILE
+CONSOLE_MAX_LINES = 5000
+CONSOLE_FLUSH_MS = 100
+CONSOLE_LOG_FILE = 'console.log'
+
+# wait after a port appears before station mode flashes it
+STATION_SETTLE_S = 0.5
+# a port that comes back this soon after its job ended is the same board
+# re-enumerating after its reset (native USB), station mode leaves it alone
+STATION_HOLDOFF_S = 10.0
+
+# hours of jobs the Stats button reports on
+STATS_HOURS = 24
+
 # this class credit marcelstoer
 # See discussion at http://stackoverflow.com/q/41101897/131929
 class RedirectText:
-    def __init__(self, text_ctrl):
-        self.out = text_ctrl
-        self.pending_backspaces = 0
+    '''stdout replacement feeding the console buffer, the widget is updated by a timer'''
+    def __init__(self, console):
+        self.console = console
 
     def write(self, string):
-        new_string = ""
-        number_of_backspaces = 0
-        for c in string:
-            if c == "\b":
-                number_of_backspaces += 1
-            else:
-                new_string += c
-
-        if self.pending_backspaces > 0:
-            # current value minus pending backspaces plus new string
-            new_value = self.out.GetValue()[:-1 * self.pending_backspaces] + new_string
-            wx.CallAfter(self.out.SetValue, new_value)
-        else:
-            wx.CallAfter(self.out.AppendText, new_string)
-
-        self.pending_backspaces = number_of_backspaces
+        self.console.write(string)
 
     def flush(self):
         None
@@ -52,21 +65,34 @@ class dfuTool(wx.Frame):
     def __init__(self, parent, title):
         super(dfuTool, self).__init__(parent, title=title)
 
-        self.baudrates = ['115200', '230400', '460800', '921600']
+        self.baudrates = ['115200', '230400', '460800', '921600', '1500000', '2000000', dfu_baud.AUTO]
         self.chip = ['auto', 'esp8266', 'esp32', 'esp32s2','esp32s3', 'esp32c2', 'esp32c3', 'esp32c6']
-        self.SetSize(800,650)
-        self.SetMinSize(wx.Size(800,650))
+        self.SetSize(800,740)
+        self.SetMinSize(wx.Size(800,740))
         self.SetIcon(wx.Icon(wx.IconLocation(sys.executable, 0)))
         self.Centre()
+        # every blocking operation runs there, see dfu_tasks
+        self.tasks = dfu_tasks.TaskRunner(wx.CallAfter)
         self.initFlags()
         self.initUI()
+        self.firmwareCache = dfu_cache.FirmwareCache()
+        self.portWatcher = dfu_ports.PortWatcher(lambda added, removed: self.tasks.post(self.on_ports_changed, added, removed))
+        self.portWatcher.start()
+        self.jobQueue = dfu_jobs.JobQueue(os.path.join(dfu_core.app_data_dir(), 'queue'))
+        # the connections to the boards, opened (and esptool loaded) by the first job
+        self.jobRunner = dfu_jobs.JobRunner(self.jobQueue, on_monitor=lambda monitor: self.tasks.post(self.show_monitor, monitor))
+        self.scheduler = dfu_jobs.JobScheduler(self.jobQueue, self.jobRunner, self.on_worker_update, self.on_job_done)
         self.ESPTOOLARG_BAUD = self.ESPTOOLARG_BAUD # this default is regrettably loaded as part of the initUI process
 
-        # Create temporary directory for extract zip files
-        self.tempDir = tempfile.mkdtemp(prefix="ESP_flasher_")
-
         print('ESP Flasher Programming tool')
         print('--------------------------------------------')
+        # the jobs queued or running as the UI knows them, so it never waits on the queue's lock
+        # (held while the queue writes to disk); kept by submit_jobs() and job_ended()
+        self.pendingJobs = set(self.jobQueue.pending())
+        if self.pendingJobs:
+            print('%d jobs left from the last run are queued again' % len(self.pendingJobs))
+        self.scheduler.start()
+        self.on_serial_scan_request(None)
 
     def initUI(self):
         '''Runs on application start to build the GUI'''
@@ -82,17 +108,16 @@ class dfuTool(wx.Frame):
         self.serialtext = wx.StaticText(self.serialPanel,label = "Serial Port:", style = wx.ALIGN_CENTRE)
         serialhbox.Add(self.serialtext,1,wx.ALL|wx.ALIGN_CENTER_VERTICAL,20)
 
-        devices = self.list_serial_devices()
-        self.serialChoice = wx.Choice(self.serialPanel, choices=devices)
+        # filled in the background once the window is up
+        self.serialChoice = wx.Choice(self.serialPanel, choices=[])
         self.serialChoice.Bind(wx.EVT_CHOICE, self.on_serial_list_select)
-        self.serialChoice.Select(0)
         serialhbox.Add(self.serialChoice,3,wx.ALL|wx.ALIGN_CENTER_VERTICAL,20)
 
         self.scanButton = wx.Button(parent=self.serialPanel, label='Rescan Ports')
         self.scanButton.Bind(wx.EVT_BUTTON, self.on_serial_scan_request)
         serialhbox.Add(self.scanButton,2,wx.ALL|wx.ALIGN_CENTER_VERTICAL,20)
 
-        self.serialAutoCheckbox = wx.CheckBox(parent=self.serialPanel,label="Auto-detect (slow)")
+        self.serialAutoCheckbox = wx.CheckBox(parent=self.serialPanel,label="Auto-detect")
         self.serialAutoCheckbox.Bind(wx.EVT_CHECKBOX,self.on_serial_autodetect_check)
         serialhbox.Add(self.serialAutoCheckbox,2,wx.ALL|wx.ALIGN_CENTER_VERTICAL,20)
 
@@ -102,6 +127,25 @@ class dfuTool(wx.Frame):
 
         vbox.Add(self.serialPanel,1, wx.LEFT|wx.RIGHT|wx.EXPAND, 20)
         ################################################################
+        #                   BEGIN MULTI-PORT GUI                       #
+        ################################################################
+        self.multiportPanel = wx.Panel(self.mainPanel)
+        multiporthbox = wx.BoxSizer(wx.HORIZONTAL)
+
+        self.multiportCheckbox = wx.CheckBox(parent=self.multiportPanel,label="Flash several ports at once")
+        self.multiportCheckbox.Bind(wx.EVT_CHECKBOX,self.on_multiport_check)
+        multiporthbox.Add(self.multiportCheckbox,2,wx.ALIGN_CENTER_VERTICAL)
+
+        self.multiportButton = wx.Button(parent=self.multiportPanel, label='Choose ports...')
+        self.multiportButton.Bind(wx.EVT_BUTTON, self.on_multiport_choose)
+        self.multiportButton.Disable()
+        multiporthbox.Add(self.multiportButton,1,wx.ALIGN_CENTER_VERTICAL)
+
+        self.multiportText = wx.StaticText(self.multiportPanel,label = "No port chosen")
+        multiporthbox.Add(self.multiportText,4,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        vbox.Add(self.multiportPanel,0, wx.LEFT|wx.RIGHT|wx.EXPAND, 40)
+        ################################################################
         #                   BEGIN BAUD RATE GUI                        #
         ################################################################
         self.baudPanel = wx.Panel(self.mainPanel)
@@ -121,7 +165,7 @@ class dfuTool(wx.Frame):
             baudhbox.Add(baudChoice, 1, wx.ALIGN_CENTER_VERTICAL)
 
             # set the default up
-            if index == len(self.baudrates) - 1:
+            if baud == DEFAULT_BAUD:
                 baudChoice.SetValue(True)
                 self.ESPTOOLARG_BAUD = baudChoice.baudrate
 
@@ -240,6 +284,67 @@ class dfuTool(wx.Frame):
 
         vbox.Add(self.bootloaderDFUpanel,1,wx.LEFT|wx.RIGHT|wx.EXPAND, 20)
         ################################################################
+        #                   BEGIN FLASH OPTIONS GUI                    #
+        ################################################################
+        self.optionsPanel = wx.Panel(self.mainPanel)
+        optionshbox = wx.WrapSizer(wx.HORIZONTAL)
+
+        self.smartFlashCheckbox = wx.CheckBox(parent=self.optionsPanel,label="Smart flash (only write sectors that changed)")
+        self.smartFlashCheckbox.Bind(wx.EVT_CHECKBOX,self.on_smart_flash_check)
+        optionshbox.Add(self.smartFlashCheckbox,0,wx.ALIGN_CENTER_VERTICAL)
+
+        self.verifyCheckbox = wx.CheckBox(parent=self.optionsPanel,label="Verify after flash")
+        self.verifyCheckbox.Bind(wx.EVT_CHECKBOX,self.on_verify_check)
+        optionshbox.Add(self.verifyCheckbox,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        self.monitorCheckbox = wx.CheckBox(parent=self.optionsPanel,label="Monitor after flash at")
+        self.monitorCheckbox.Bind(wx.EVT_CHECKBOX,self.on_monitor_check)
+        optionshbox.Add(self.monitorCheckbox,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        self.monitorBaudText = wx.TextCtrl(parent=self.optionsPanel, value=str(dfu_monitor.MONITOR_BAUD), size=(70,-1))
+        optionshbox.Add(self.monitorBaudText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        self.passPatternText = wx.TextCtrl(parent=self.optionsPanel, value='', size=(100,-1))
+        self.passPatternText.SetToolTip('regular expression of the line a passed self-test prints, e.g. "SELFTEST PASS"')
+        optionshbox.Add(self.passPatternText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        self.failPatternText = wx.TextCtrl(parent=self.optionsPanel, value='', size=(100,-1))
+        self.failPatternText.SetToolTip('regular expression of the line a failed self-test prints, e.g. "FAIL|Guru Meditation"')
+        optionshbox.Add(self.failPatternText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        self.stationCheckbox = wx.CheckBox(parent=self.optionsPanel,label="Station mode (flash every board plugged in)")
+        self.stationCheckbox.Bind(wx.EVT_CHECKBOX,self.on_station_check)
+        optionshbox.Add(self.stationCheckbox,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        self.reworkCheckbox = wx.CheckBox(parent=self.optionsPanel,label="Rework (ahead of the queue)")
+        self.reworkCheckbox.Bind(wx.EVT_CHECKBOX,self.on_rework_check)
+        optionshbox.Add(self.reworkCheckbox,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        self.regionEraseCheckbox = wx.CheckBox(parent=self.optionsPanel,label="Erase only flashed regions, and partitions:")
+        self.regionEraseCheckbox.Bind(wx.EVT_CHECKBOX,self.on_region_erase_check)
+        optionshbox.Add(self.regionEraseCheckbox,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        self.erasePartitionsText = wx.TextCtrl(parent=self.optionsPanel, value='', size=(100,-1))
+        self.erasePartitionsText.SetToolTip('partition labels to erase too, e.g. "nvs otadata"')
+        self.erasePartitionsText.Disable()
+        optionshbox.Add(self.erasePartitionsText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        self.readRangeText = wx.StaticText(self.optionsPanel, label="Read from:")
+        optionshbox.Add(self.readRangeText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,20)
+
+        self.readAddrText = wx.TextCtrl(parent=self.optionsPanel, value='0x0', size=(80,-1))
+        self.readAddrText.SetToolTip('flash address Read ESP starts at')
+        optionshbox.Add(self.readAddrText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        self.readSizeText = wx.TextCtrl(parent=self.optionsPanel, value='0x400000', size=(80,-1))
+        self.readSizeText.SetToolTip('bytes Read ESP reads')
+        optionshbox.Add(self.readSizeText,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        self.readPartitionsCheckbox = wx.CheckBox(parent=self.optionsPanel,label="or every partition to its own file")
+        optionshbox.Add(self.readPartitionsCheckbox,0,wx.LEFT|wx.ALIGN_CENTER_VERTICAL,5)
+
+        vbox.Add(self.optionsPanel,0, wx.TOP|wx.LEFT|wx.RIGHT|wx.EXPAND, 20)
+        ################################################################
         #                   BEGIN FLASH BUTTON GUI                     #
         ################################################################
         self.buttonPanel = wx.Panel(self.mainPanel)
@@ -249,18 +354,54 @@ class dfuTool(wx.Frame):
         self.eraseButton.Bind(wx.EVT_BUTTON, self.on_erase_button)
         buttonhbox.Add(self.eraseButton, 1, wx.RIGHT|wx.EXPAND, 40)
 
+        self.readButton = wx.Button(parent=self.buttonPanel, label='Read ESP')
+        self.readButton.Bind(wx.EVT_BUTTON, self.on_read_button)
+        buttonhbox.Add(self.readButton, 1, wx.EXPAND)
+
+        self.verifyButton = wx.Button(parent=self.buttonPanel, label='Verify ESP')
+        self.verifyButton.SetToolTip('compare the flash of the board with the images checked, without writing')
+        self.verifyButton.Bind(wx.EVT_BUTTON, self.on_verify_button)
+        buttonhbox.Add(self.verifyButton, 1, wx.LEFT|wx.EXPAND, 40)
+
         self.flashButton = wx.Button(parent=self.buttonPanel, label='Flash ESP')
         self.flashButton.Bind(wx.EVT_BUTTON, self.on_flash_button)
         buttonhbox.Add(self.flashButton, 3, wx.LEFT|wx.EXPAND, 40)
 
+        self.statsButton = wx.Button(parent=self.buttonPanel, label='Stats')
+        self.statsButton.SetToolTip('production statistics of the last %g hours' % STATS_HOURS)
+        self.statsButton.Bind(wx.EVT_BUTTON, self.on_stats_button)
+        buttonhbox.Add(self.statsButton, 1, wx.LEFT|wx.EXPAND, 40)
+
         vbox.Add(self.buttonPanel,2, wx.TOP|wx.LEFT|wx.RIGHT|wx.EXPAND, 20)
         ################################################################
         #                   BEGIN CONSOLE OUTPUT GUI                   #
         ################################################################
-        self.consolePanel = wx.TextCtrl(self.mainPanel, style=wx.TE_MULTILINE|wx.TE_READONLY)
-        sys.stdout = RedirectText(self.consolePanel)
+        consolehbox = wx.BoxSizer(wx.HORIZONTAL)
 
-        vbox.Add(self.consolePanel,7, wx.ALL|wx.EXPAND, 20)
+        self.consolePanel = wx.TextCtrl(self.mainPanel, style=wx.TE_MULTILINE|wx.TE_READONLY)
+        self.console = dfu_console.ConsoleBuffer(CONSOLE_MAX_LINES, os.path.join(dfu_core.app_data_dir(), CONSOLE_LOG_FILE))
+        sys.stdout = RedirectText(self.console)
+
+        self.consoleTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_console_timer, self.consoleTimer)
+        self.consoleTimer.Start(CONSOLE_FLUSH_MS)
+        consolehbox.Add(self.consolePanel,3,wx.EXPAND)
+
+        # boot log of the board last monitored after its flash
+        self.monitorPanel = wx.TextCtrl(self.mainPanel, style=wx.TE_MULTILINE|wx.TE_READONLY)
+        self.monitorPanel.Hide()
+        consolehbox.Add(self.monitorPanel,2,wx.LEFT|wx.EXPAND,10)
+
+        # one row per port when flashing several boards at once
+        self.portList = wx.ListCtrl(self.mainPanel, style=wx.LC_REPORT|wx.LC_SINGLE_SEL)
+        self.portList.InsertColumn(0, 'Port', width=90)
+        self.portList.InsertColumn(1, 'Status', width=70)
+        self.portList.InsertColumn(2, 'Progress', width=60)
+        self.portList.InsertColumn(3, 'kbit/s', width=60)
+        self.portList.Hide()
+        consolehbox.Add(self.portList,1,wx.LEFT|wx.EXPAND,10)
+
+        vbox.Add(consolehbox,7, wx.ALL|wx.EXPAND, 20)
         ################################################################
         #                ASSOCIATE PANELS TO SIZERS                    #
         ################################################################
@@ -270,15 +411,28 @@ class dfuTool(wx.Frame):
         self.spiffsDFUpanel.SetSizer(spiffshbox)
         self.bootloaderDFUpanel.SetSizer(bootloaderhbox)
         self.serialPanel.SetSizer(serialhbox)
+        self.multiportPanel.SetSizer(multiporthbox)
+        self.optionsPanel.SetSizer(optionshbox)
         self.projectPanel.SetSizer(projecthbox)
         self.baudPanel.SetSizer(baudhbox)
         self.mainPanel.SetSizer(vbox)
 
     def initFlags(self):
         '''Initialises the flags used to control the program flow'''
-        self.ESPTOOL_BUSY = False
-
         self.ESPTOOLARG_AUTOSERIAL = False
+        self.ESPTOOLARG_MULTIPORT = False
+        self.ESPTOOLARG_SMARTFLASH = False
+        self.ESPTOOLARG_VERIFY = False
+        self.ESPTOOLARG_MONITOR = False
+        self.ESPTOOLARG_STATION = False
+        self.ESPTOOLARG_REGIONERASE = False
+        self.ESPTOOLARG_REWORK = False
+        self.multiPorts = []
+        # port -> when its last job ended, see station_flash()
+        self.portsFinished = {}
+        # SerialMonitor shown in the monitor panel, and every one started
+        self.monitor = None
+        self.monitors = []
 
         self.PROJFILE_SELECTED = False
         self.APPFILE_SELECTED = False
@@ -286,14 +440,26 @@ class dfuTool(wx.Frame):
         self.SPIFFSFILE_SELECTED = False
         self.BOOTLOADERFILE_SELECTED = False
 
-        self.ESPTOOLMODE_ERASE = False
-        self.ESPTOOLMODE_FLASH = False
+        # role -> FirmwareImage held in memory, see set_image()
+        self.images = {}
+        self.projectRoles = []
+        # parsed table of the selected partitions image
+        self.partitions = None
+        # True for a chip erase, or the [(offset, size)] regions to erase
+        self.eraseRegions = True
 
         self.ESPTOOL_ERASE_USED = False
 
     ################################################################
     #                      UI EVENT HANDLERS                       #
     ################################################################
+    def on_startup_ready(self):
+        '''First call of the event loop, the window is up and answering'''
+        STARTUP.mark('ready')
+        print('Startup: ' + STARTUP.summary())
+        log = dfu_metrics.MetricsLog(os.path.join(dfu_core.app_data_dir(), 'startup.jsonl'))
+        self.tasks.run(log.append, STARTUP)
+
     def on_serial_scan_request(self, event):
         # disallow if automatic serial port is chosen
         if self.ESPTOOLARG_AUTOSERIAL:
@@ -302,7 +468,11 @@ class dfuTool(wx.Frame):
 
         # repopulate the serial port choices and update the selected port
         print('rescanning serial ports...')
-        devices = self.list_serial_devices()
+        self.tasks.run(self.list_serial_devices, on_done=self.set_serial_choices, name='port scan')
+
+    def set_serial_choices(self, devices):
+        if self.ESPTOOLARG_AUTOSERIAL:
+            return
         self.serialChoice.Clear()
         for device in devices:
             self.serialChoice.Append(device)
@@ -310,8 +480,13 @@ class dfuTool(wx.Frame):
         print('serial choices updated')
 
     def on_serial_reset_device(self, event):
+        port = self.serialChoice.GetString(self.serialChoice.GetSelection())
+        self.tasks.run(self.reset_device, port, name='reset ' + port)
+
+    def reset_device(self, name):
+        import serial
         try:
-            port = serial.Serial(self.serialChoice.GetString(self.serialChoice.GetSelection())) 
+            port = serial.Serial(name)
             print('reset device connected on port ' + port.name)
             port.setDTR(False)
             port.setRTS(True)
@@ -336,26 +511,206 @@ class dfuTool(wx.Frame):
         else:
             self.on_serial_scan_request(event)
 
+    def on_multiport_check(self,event):
+        self.ESPTOOLARG_MULTIPORT = self.multiportCheckbox.GetValue()
+
+        if self.ESPTOOLARG_MULTIPORT:
+            self.multiportButton.Enable()
+            self.serialChoice.Disable()
+            self.serialAutoCheckbox.Disable()
+        else:
+            self.multiportButton.Disable()
+            self.serialChoice.Enable()
+            self.serialAutoCheckbox.Enable()
+
+        self.show_port_list()
+
+    def on_multiport_choose(self,event):
+        self.tasks.run(self.list_serial_devices, on_done=self.choose_multiports, name='port scan')
+
+    def choose_multiports(self, devices):
+        with wx.MultiChoiceDialog(self, 'Ports to flash in parallel', 'Choose ports', devices) as dialog:
+            dialog.SetSelections([i for i, device in enumerate(devices) if device in self.multiPorts])
+            if dialog.ShowModal() == wx.ID_CANCEL:
+                return
+            self.multiPorts = [devices[i] for i in dialog.GetSelections()]
+
+        self.portList.DeleteAllItems()
+        for port in self.multiPorts:
+            self.portList.Append([port, dfu_core.PortWorker.WAITING, ''])
+
+        if self.multiPorts:
+            self.multiportText.SetLabel(', '.join(self.multiPorts))
+        else:
+            self.multiportText.SetLabel('No port chosen')
+        print('ports chosen: ' + ', '.join(self.multiPorts))
+
+    def on_ports_changed(self, added, removed):
+        '''Called on the UI thread by the port watcher when ports come and go'''
+        for device in removed:
+            print('port removed: ' + device)
+            self.tasks.run(self.jobRunner.release, device)
+            index = self.serialChoice.FindString(device)
+            if not self.ESPTOOLARG_AUTOSERIAL and index != wx.NOT_FOUND:
+                self.serialChoice.Delete(index)
+
+        for port in added:
+            print('port added: ' + port.label())
+            if not self.ESPTOOLARG_AUTOSERIAL:
+                self.serialChoice.Append(port.device)
+            if self.ESPTOOLARG_STATION and port.bridge:
+                self.station_flash(port.device)
+
+        if self.serialChoice.GetSelection() == wx.NOT_FOUND and self.serialChoice.GetCount():
+            self.serialChoice.Select(0)
+
+    def on_region_erase_check(self,event):
+        self.ESPTOOLARG_REGIONERASE = self.regionEraseCheckbox.GetValue()
+        if self.ESPTOOLARG_REGIONERASE:
+            self.erasePartitionsText.Enable()
+        else:
+            self.erasePartitionsText.Disable()
+
+    def on_station_check(self,event):
+        self.ESPTOOLARG_STATION = self.stationCheckbox.GetValue()
+        if self.ESPTOOLARG_STATION:
+            print('station mode: every board plugged in from now on is flashed')
+        else:
+            print('station mode off')
+        self.show_port_list()
+
+    def show_port_list(self):
+        '''The port list shows in multi-port and station modes, and while jobs are queued or running'''
+        self.portList.Show(self.ESPTOOLARG_MULTIPORT or self.ESPTOOLARG_STATION or bool(self.pendingJobs))
+        self.mainPanel.Layout()
+
+    def on_port_update(self, port, status, progress, rate=None):
+        '''Called on the UI thread when the status, progress or throughput of a port worker changes'''
+        index = self.portList.FindItem(-1, port)
+        if index != wx.NOT_FOUND:
+            self.portList.SetItem(index, 1, status)
+            self.portList.SetItem(index, 2, str(progress) + ' %')
+            self.portList.SetItem(index, 3, '%.0f' % rate if rate is not None else '')
+
+    def on_console_timer(self, event):
+        '''Apply everything written to the console (and the monitor) since the last tick in one go'''
+        self.apply_update(self.consolePanel, self.console.take_update())
+        if self.monitor is not None:
+            self.apply_update(self.monitorPanel, self.monitor.buffer.take_update())
+
+    def apply_update(self, panel, update):
+        '''Apply a ConsoleBuffer.take_update() to a text control'''
+        if update is None:
+            return
+
+        drop, rewrite_tail, text = update
+        # positions are computed from line numbers, on Windows a newline counts for two
+        if drop:
+            panel.Remove(0, panel.XYToPosition(0, drop))
+        if rewrite_tail:
+            last_line = panel.GetNumberOfLines() - 1
+            panel.Remove(panel.XYToPosition(0, last_line), panel.GetLastPosition())
+        panel.AppendText(text)
+
+    def show_monitor(self, monitor):
+        '''Show the boot log of a board whose monitor just started'''
+        self.monitors = [m for m in self.monitors if m.result is None] + [monitor]
+        self.monitor = monitor
+        self.monitorPanel.Clear()
+        self.monitorPanel.Show()
+        self.Layout()
+
+    def on_smart_flash_check(self,event):
+        self.ESPTOOLARG_SMARTFLASH = self.smartFlashCheckbox.GetValue()
+
+    def on_verify_check(self,event):
+        self.ESPTOOLARG_VERIFY = self.verifyCheckbox.GetValue()
+
+    def on_monitor_check(self,event):
+        self.ESPTOOLARG_MONITOR = self.monitorCheckbox.GetValue()
+
+    def on_rework_check(self,event):
+        self.ESPTOOLARG_REWORK = self.reworkCheckbox.GetValue()
+
     def on_baud_selected(self,event):
         selection = event.GetEventObject()
         self.ESPTOOLARG_BAUD = selection.baudrate
         print('baud set to '+selection.baudrate)
 
     def on_erase_button(self, event):
-        if self.ESPTOOL_BUSY:
-            print('currently busy')
+        if self.ESPTOOLARG_MULTIPORT and not self.multiPorts:
+            print('no port chosen for parallel erase')
             return
         
-        dialog = wx.MessageDialog(self.mainPanel, 'You want to \"Erase ESP\", which means you should reflash all files. Are you sure you want to continue? ','Warning',wx.YES_NO|wx.ICON_EXCLAMATION)
+        if self.ESPTOOLARG_REGIONERASE:
+            try:
+                self.eraseRegions = dfu_partitions.erase_plan(self.selected_images(), self.partitions,
+                                                              self.erasePartitionsText.GetValue().replace(',', ' ').split())
+            except ValueError as e:
+                print(e)
+                return
+            if not self.eraseRegions:
+                print('nothing to erase, check the images to flash or name partitions')
+                return
+            for offset, size in self.eraseRegions:
+                print('will erase 0x%08x-0x%08x' % (offset, offset + size))
+            message = 'You want to erase %d KB in %d regions. Are you sure you want to continue? ' \
+                      % (sum(size for _, size in self.eraseRegions) // 1024, len(self.eraseRegions))
+        else:
+            self.eraseRegions = True
+            message = 'You want to \"Erase ESP\", which means you should reflash all files. Are you sure you want to continue? '
+
+        dialog = wx.MessageDialog(self.mainPanel, message,'Warning',wx.YES_NO|wx.ICON_EXCLAMATION)
         ret = dialog.ShowModal()
 
         if ret == wx.ID_NO:
             return
                 
-        self.ESPTOOLMODE_ERASE = True
         self.ESPTOOL_ERASE_USED = True
-        t = threading.Thread(target=self.esptoolRunner, daemon=True)
-        t.start()
+        self.submit_jobs(dfu_jobs.ERASE, self.job_ports(), self.eraseRegions)
+
+    def on_read_button(self, event):
+        if self.ESPTOOLARG_MULTIPORT and not self.multiPorts:
+            print('no port chosen for parallel read')
+            return
+
+        if self.readPartitionsCheckbox.IsChecked():
+            if not self.partitions:
+                print('no partition table selected to read the partitions of')
+                return
+            with wx.DirDialog(self, "Read partitions to") as dirDialog:
+
+                if dirDialog.ShowModal() == wx.ID_CANCEL:
+                    return
+
+                path = dirDialog.GetPath()
+            regions = dfu_partitions.dump_regions(self.partitions, path)
+        else:
+            try:
+                address = int(self.readAddrText.GetValue(), 0)
+                size = int(self.readSizeText.GetValue(), 0)
+            except ValueError:
+                print('bad read address or size')
+                return
+            with wx.FileDialog(self, "Save", "", "flash_0x%x.bin" % address, "*.bin",
+                               wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
+
+                if fileDialog.ShowModal() == wx.ID_CANCEL:
+                    return
+
+                path = fileDialog.GetPath()
+            regions = [(address, size, path)]
+
+        self.submit_jobs(dfu_jobs.READ, self.job_ports(), regions=regions)
+
+    def on_stats_button(self, event):
+        self.tasks.run(lambda: dfu_core.stats().report(STATS_HOURS), on_done=self.show_stats, name='stats')
+
+    def show_stats(self, report):
+        import dfu_stats
+        print('--------------------------------------------')
+        for line in dfu_stats.format_report(report):
+            print(line)
 
     def on_project_browse_button(self, event):
         with wx.FileDialog(self, "Open", "", "","*.zip", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
@@ -373,6 +728,22 @@ class dfuTool(wx.Frame):
         #load settings
         self.load_options()
 
+    def load_image(self, role, path):
+        '''Read a .bin file in the background and select it for role'''
+        self.tasks.run(self.read_image, role, os.path.abspath(path),
+                       on_done=lambda image: self.set_image(role, image))
+
+    def read_image(self, role, path):
+        '''Worker side of load_image: the image, its ESP header parsed if it has one'''
+        image = dfu_project.FirmwareImage.from_file(role, path)
+        if role in dfu_header.HEADER_ROLES:
+            try:
+                dfu_header.header_of(image)
+            except ValueError:
+                # reported by select_chip() and refused at flash time
+                pass
+        return image
+
     def on_app_browse_button(self, event):
         with wx.FileDialog(self, "Open", "", "","*.bin", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
 
@@ -380,10 +751,8 @@ class dfuTool(wx.Frame):
                 return
 
             path = fileDialog.GetPath()
-            self.APPFILE_SELECTED = True
 
-        self.app_pathtext.SetValue(os.path.abspath(path))
-        self.appDFUCheckbox.SetValue(True)
+        self.load_image('app', path)
 
     def on_partition_browse_button(self, event):
         with wx.FileDialog(self, "Open", "", "","*.bin", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
@@ -392,10 +761,8 @@ class dfuTool(wx.Frame):
                 return
 
             path = fileDialog.GetPath()
-            self.PARTITIONFILE_SELECTED = True
 
-        self.partition_pathtext.SetValue(os.path.abspath(path))
-        self.partitionDFUCheckbox.SetValue(True)
+        self.load_image('partitions', path)
 
     def on_spiffs_browse_button(self, event):
         with wx.FileDialog(self, "Open", "", "","*.bin", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
@@ -404,10 +771,8 @@ class dfuTool(wx.Frame):
                 return
 
             path = fileDialog.GetPath()
-            self.SPIFFSFILE_SELECTED = True
 
-        self.spiffs_pathtext.SetValue(os.path.abspath(path))
-        self.spiffsDFUCheckbox.SetValue(True)
+        self.load_image('spiffs', path)
 
     def on_bootloader_browse_button(self, event):
         with wx.FileDialog(self, "Open", "", "","*.bin", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
@@ -416,179 +781,270 @@ class dfuTool(wx.Frame):
                 return
 
             path = fileDialog.GetPath()
-            self.BOOTLOADERFILE_SELECTED = True
 
-        self.bootloader_pathtext.SetValue(os.path.abspath(path))
-        self.bootloaderDFUCheckbox.SetValue(True)
+        self.load_image('bootloader', path)
 
     def on_flash_button(self, event):
-        if self.ESPTOOL_BUSY:
-            print('currently busy')
+        if self.ESPTOOLARG_MULTIPORT and not self.multiPorts:
+            print('no port chosen for parallel flash')
             return
-        # handle cases where a flash has been requested but no file provided
-        elif self.appDFUCheckbox.IsChecked() & ~self.APPFILE_SELECTED:
-            print('no app selected for flash')
+        problem = self.flash_request_problem()
+        if problem:
+            print(problem)
             return
-        elif self.partitionDFUCheckbox.IsChecked() & ~self.PARTITIONFILE_SELECTED:
-            print('no partition table selected for flash')
+
+        self.submit_jobs(dfu_jobs.FLASH, self.job_ports())
+
+    def on_verify_button(self, event):
+        if self.ESPTOOLARG_MULTIPORT and not self.multiPorts:
+            print('no port chosen for parallel verify')
             return
-        elif self.spiffsDFUCheckbox.IsChecked() & ~self.SPIFFSFILE_SELECTED:
-            print('no spiffs file selected for flash')
-            return        
-        elif self.bootloaderDFUCheckbox.IsChecked() & ~self.BOOTLOADERFILE_SELECTED:
-            print('no bootloader selected for flash')
+        problem = self.flash_request_problem()
+        if problem:
+            print(problem)
             return
-        else:
-            # if we're uploading everything, clear the fact that erase_flash has been used
-            if  not self.appDFUCheckbox.IsChecked() and \
-                not self.partitionDFUCheckbox.IsChecked() and \
-                not self.spiffsDFUCheckbox.IsChecked() and \
-                not self.bootloaderDFUCheckbox.IsChecked():
-                print('nothing to do !')
-                return
 
-            self.ESPTOOLMODE_FLASH = True
-            t = threading.Thread(target=self.esptoolRunner, daemon=True)
-            t.start()
+        self.submit_jobs(dfu_jobs.VERIFY, self.job_ports())
 
     ################################################################
     #                      MISC FUNCTIONS                          #
     ################################################################
     def list_serial_devices(self):
-        ports = serial.tools.list_ports.comports()
-        ports.sort()
-        devices = []
-        for port in ports:
-            devices.append(port.device)
-        return devices
+        '''Port names, the ones behind a known ESP USB bridge first'''
+        return [port.device for port in dfu_ports.list_ports()]
+
+    def flash_request_problem(self):
+        '''Why a flash can't start with the images chosen, or None'''
+        # handle cases where a flash has been requested but no file provided
+        if self.appDFUCheckbox.IsChecked() & ~self.APPFILE_SELECTED:
+            return 'no app selected for flash'
+        elif self.partitionDFUCheckbox.IsChecked() & ~self.PARTITIONFILE_SELECTED:
+            return 'no partition table selected for flash'
+        elif self.spiffsDFUCheckbox.IsChecked() & ~self.SPIFFSFILE_SELECTED:
+            return 'no spiffs file selected for flash'
+        elif self.bootloaderDFUCheckbox.IsChecked() & ~self.BOOTLOADERFILE_SELECTED:
+            return 'no bootloader selected for flash'
+        elif not self.selected_images():
+            return 'nothing to do !'
+        if self.ESPTOOLARG_MONITOR:
+            try:
+                self.monitor_settings()
+            except (ValueError, re.error) as e:
+                return 'bad monitor setting: ' + str(e)
+        try:
+            dfu_partitions.check_images(self.selected_images(), self.partitions)
+            dfu_header.check_images(self.selected_images(), self.chipChoice.GetString(self.chipChoice.GetSelection()))
+        except ValueError as e:
+            return str(e)
+        return None
 
     # load project file and set up the options correctly
     def load_options(self):
         if not self.PROJFILE_SELECTED:
             return
 
+        self.tasks.run(self.read_project, self.projectText.GetValue(),
+                       on_done=self.set_project_images, on_error=self.on_project_error, name='zip load')
+
+    def read_project(self, path):
+        '''Worker side of load_options: the images of a zip, their ESP headers parsed (or read from the cache)'''
+        images = self.firmwareCache.load(path)
         try:
-            with ZipFile(self.projectText.GetValue(), 'r') as zip:
-                print("Open zip file...")
-                zip.printdir()
-                zip.extractall(str(self.tempDir))
-
-            # Search if firmware file exist
-            file = list(pathlib.Path(self.tempDir).glob('firmware_*.bin'))
-            if len(file):
-                self.app_pathtext.SetValue(str(file[0].name))
-                self.APPFILE_SELECTED = True
-                self.appDFUCheckbox.SetValue(True)
-
-            # Search if partitions file exist
-            file = list(pathlib.Path(self.tempDir).glob('partitions_*.bin'))
-            if len(file):
-                self.partition_pathtext.SetValue(str(file[0].name))
-                self.PARTITIONFILE_SELECTED = True
-                self.partitionDFUCheckbox.SetValue(True)
-
-            # Search if spiffs file exist
-            file = list(pathlib.Path(self.tempDir).glob('spiffs_*.bin'))
-            if len(file):
-                self.spiffs_pathtext.SetValue(str(file[0].name))
-                self.SPIFFSFILE_SELECTED = True
-                self.spiffsDFUCheckbox.SetValue(True)
-
-            # Search if bootloader file exist
-            file = list(pathlib.Path(self.tempDir).glob('bootloader_*.bin'))
-            if len(file):
-                self.bootloader_pathtext.SetValue(str(file[0].name))
-                self.BOOTLOADERFILE_SELECTED = True
-                self.bootloaderDFUCheckbox.SetValue(True)
-
-        except Exception as e:
-            print(e)
-            wx.MessageDialog(self, 'Error loading zip file', caption='Error')
+            self.firmwareCache.headers(images.values())
+        except ValueError:
+            # reported by select_chip() and refused at flash time
+            pass
+        return images
+
+    def set_project_images(self, images):
+        for role, image in images.items():
+            self.set_image(role, image)
+        self.projectRoles = list(images)
+
+    def on_project_error(self, error):
+        print(error)
+        wx.MessageDialog(self, 'Error loading zip file', caption='Error')
 
     def clean_options(self):
-        shutil.rmtree(self.tempDir)
+        '''Forget the images of the previously loaded project'''
+        for role in self.projectRoles:
+            self.set_image(role, None)
+        self.projectRoles = []
+
+    def set_image(self, role, image):
+        '''Select the image flashed for a role, or forget it with None'''
+        checkbox, pathtext, flag = {
+            'app': (self.appDFUCheckbox, self.app_pathtext, 'APPFILE_SELECTED'),
+            'partitions': (self.partitionDFUCheckbox, self.partition_pathtext, 'PARTITIONFILE_SELECTED'),
+            'spiffs': (self.spiffsDFUCheckbox, self.spiffs_pathtext, 'SPIFFSFILE_SELECTED'),
+            'bootloader': (self.bootloaderDFUCheckbox, self.bootloader_pathtext, 'BOOTLOADERFILE_SELECTED'),
+        }[role]
+
+        if role == 'partitions':
+            self.set_partitions(image)
+
+        if image is None:
+            self.images.pop(role, None)
+            pathtext.SetValue('No File Selected')
+            setattr(self, flag, False)
+        else:
+            self.images[role] = image
+            pathtext.SetValue(image.name)
+            setattr(self, flag, True)
+            checkbox.SetValue(True)
+            # compress and hash in the background so it is done before the first flash
+            self.tasks.run(self.firmwareCache.precompress, [image])
+            for name in dfu_project.DIGESTS:
+                self.tasks.run(image.digest, name)
+            if role in dfu_header.HEADER_ROLES:
+                self.select_chip()
+
+    def select_chip(self):
+        '''Choose the chip the bootloader and app are built for, and where its bootloader goes
+
+        The chip is then known when connecting, no detection needed.
+        '''
+        images = [(None, self.images[role]) for role in dfu_header.HEADER_ROLES if role in self.images]
+        try:
+            chip = dfu_header.project_chip(images)
+        except ValueError as e:
+            print('--- ERROR ---')
+            print(e)
+            return
+        if chip is None or chip not in self.chip:
+            return
+        if chip != self.chipChoice.GetString(self.chipChoice.GetSelection()):
+            print('images built for ' + chip + ', chip set')
+        self.chipChoice.SetStringSelection(chip)
+        self.bootloaderAddrText.SetValue(dfu_header.bootloader_address(chip))
+
+    def set_partitions(self, image):
+        '''Parse a partition table image and take the app and spiffs addresses from it'''
+        self.partitions = None
+        if image is None:
+            return
+        try:
+            self.partitions = dfu_partitions.parse_partitions(image.data)
+        except ValueError as e:
+            print(image.name + ': ' + str(e))
+            return
+
+        print('partition table:')
+        for partition in self.partitions:
+            print('  ' + repr(partition))
+        addresses = dfu_partitions.role_addresses(self.partitions)
+        if 'app' in addresses:
+            self.appAddrText.SetValue(addresses['app'])
+        if 'spiffs' in addresses:
+            self.spiffsAddrText.SetValue(addresses['spiffs'])
+
+    def selected_images(self):
+        '''[(address, FirmwareImage)] of every checked image, in flash order; checked roles with no file are left out'''
+        images = []
+        if self.bootloaderDFUCheckbox.IsChecked() and 'bootloader' in self.images:
+            images.append((self.bootloaderAddrText.GetValue(), self.images['bootloader']))
+        if self.partitionDFUCheckbox.IsChecked() and 'partitions' in self.images:
+            images.append((self.partitionAddrText.GetValue(), self.images['partitions']))
+        if self.appDFUCheckbox.IsChecked() and 'app' in self.images:
+            images.append((self.appAddrText.GetValue(), self.images['app']))
+        if self.spiffsDFUCheckbox.IsChecked() and 'spiffs' in self.images:
+            images.append((self.spiffsAddrText.GetValue(), self.images['spiffs']))
+        return images
+
+    def monitor_settings(self):
+        '''SerialMonitor keywords of the monitor options, ValueError or re.error if they are bad'''
+        settings = {'baud': int(self.monitorBaudText.GetValue()),
+                    'pass_pattern': self.passPatternText.GetValue() or None,
+                    'fail_pattern': self.failPatternText.GetValue() or None}
+        for pattern in (settings['pass_pattern'], settings['fail_pattern']):
+            if pattern:
+                re.compile(pattern)
+        return settings
 
     ################################################################
     #                    ESPTOOL FUNCTIONS                         #
     ################################################################
-    def esptool_cmd_builder(self):
-        '''Build the command that we would give esptool on the CLI'''
-        cmd = ['--baud',self.ESPTOOLARG_BAUD]
-        cmd = cmd + ['--chip', self.chipChoice.GetString(self.chipChoice.GetSelection())]
-        cmd = cmd + ['--before', 'default_reset']
-        cmd = cmd + ['--after', 'hard_reset']
-
-        if self.ESPTOOLARG_AUTOSERIAL == False:
-            cmd = cmd + ['--port',self.serialChoice.GetString(self.serialChoice.GetSelection())]
-
-        if self.ESPTOOLMODE_ERASE:
-            cmd.append('erase_flash')
-        elif self.ESPTOOLMODE_FLASH:
-            cmd.append('write_flash')
-            if self.bootloaderDFUCheckbox.IsChecked():
-                cmd.append(self.bootloaderAddrText.GetValue())
-                cmd.append(str(pathlib.Path(self.tempDir) / self.bootloader_pathtext.GetValue()))
-            if self.partitionDFUCheckbox.IsChecked():
-                cmd.append(self.partitionAddrText.GetValue())
-                cmd.append(str(pathlib.Path(self.tempDir) / self.partition_pathtext.GetValue()))
-            if self.appDFUCheckbox.IsChecked():
-                cmd.append(self.appAddrText.GetValue())
-                cmd.append(str(pathlib.Path(self.tempDir) / self.app_pathtext.GetValue()))
-            if self.spiffsDFUCheckbox.IsChecked():
-                cmd.append(self.spiffsAddrText.GetValue())
-                cmd.append(str(pathlib.Path(self.tempDir) / self.spiffs_pathtext.GetValue()))
-
-        return cmd
-
-    def esptoolRunner(self):
-        '''Handles the interaction with esptool'''
-        self.ESPTOOL_BUSY = True
-
-        # Disable all button
-        self.eraseButton.Disable()
-        self.project_browseButton.Disable()
-        self.app_browseButton.Disable()
-        self.partition_browseButton.Disable()
-        self.spiffs_browseButton.Disable()
-        self.bootloader_browseButton.Disable()
-        self.flashButton.Disable()
-
-        cmd = self.esptool_cmd_builder()
-        try:
-            print('')
-            print('--- FLASH STARTED ---')
-            esptool.main(cmd)
-            print('')
-            print('----------------------------------')
-            print('--- FINISHED SUCCESSFULLY ---')
-            print('----------------------------------')
-        except esptool.FatalError as e:
-            print('')
-            print('--- ERROR ---')
-            print(e)
-            pass
-        except serial.SerialException as e:
-            print('--- ERROR ---')
-            print(e)
-            pass
-        except Exception as e:
-            print('--- ERROR ---')
-            print(e)
-            print('unexpected error, maybe you chose invalid files, or files which overlap')
-            pass
+    def job_ports(self):
+        '''Ports the buttons act on, None standing for the auto-detected board'''
+        if self.ESPTOOLARG_MULTIPORT:
+            return list(self.multiPorts)
+        if self.ESPTOOLARG_AUTOSERIAL:
+            return [None]
+        return [self.serialChoice.GetString(self.serialChoice.GetSelection())]
+
+    def submit_jobs(self, kind, ports, erase=False, delay=0, regions=()):
+        '''Read the GUI once and queue a job of kind on every port, the scheduler runs them
+
+        erase is True for a chip erase or [(offset, size)] regions to erase first.
+        regions are the [(address, size, path)] a READ job dumps, to one file per port
+        when there are several ports.
+        '''
+        baud = self.ESPTOOLARG_BAUD
+        chip = self.chipChoice.GetString(self.chipChoice.GetSelection())
+        images = self.selected_images() if kind in (dfu_jobs.FLASH, dfu_jobs.VERIFY) else []
+        priority = dfu_jobs.PRIORITY_REWORK if self.ESPTOOLARG_REWORK else dfu_jobs.PRIORITY_NORMAL
+        monitor = self.monitor_settings() if self.ESPTOOLARG_MONITOR and kind == dfu_jobs.FLASH else None
 
-        self.ESPTOOL_BUSY = False
-        self.ESPTOOLMODE_ERASE = False
-        self.ESPTOOLMODE_FLASH = False
+        for port in ports:
+            job = dfu_jobs.FlashJob(kind, port, baud, chip, erase=erase, smart=self.ESPTOOLARG_SMARTFLASH,
+                                    verify=self.ESPTOOLARG_VERIFY, monitor=monitor, priority=priority,
+                                    regions=[(address, size, dfu_core.port_path(path, port) if len(ports) > 1 else path)
+                                             for address, size, path in regions])
+            job.not_before = time.time() + delay
+            # the progress of every job shows in the port list, auto-detected boards under 'auto'
+            if self.portList.FindItem(-1, port or 'auto') == wx.NOT_FOUND:
+                self.portList.Append([port or 'auto', dfu_core.PortWorker.WAITING, ''])
+            self.pendingJobs.add(job)
+            # the queue writes the images to disk
+            self.tasks.run(self.jobQueue.submit, job, images, on_done=lambda _, job=job: print('queued ' + job.describe()),
+                           on_error=lambda error, job=job: self.job_not_queued(job, error))
+        self.portList.Show()
+        self.mainPanel.Layout()
+
+    def job_not_queued(self, job, error):
+        self.pendingJobs.discard(job)
+        self.tasks.report(error)
+
+    def job_ended(self, job):
+        '''Called on the UI thread after every run of job'''
+        if job.state != dfu_jobs.QUEUED:
+            self.pendingJobs.discard(job)
+        if job.port is not None:
+            self.portsFinished[job.port] = time.time()
+
+    def on_job_done(self, job):
+        '''Called from the worker thread of a job after every run'''
+        self.tasks.post(self.job_ended, job)
+        if job.state == dfu_jobs.DONE:
+            print('--- ' + job.describe() + ': FINISHED SUCCESSFULLY ---')
+        elif job.state == dfu_jobs.QUEUED:
+            print('--- %s: FAILED, attempt %d of %d, retrying in %.0f seconds ---'
+                  % (job.describe(), job.attempts, job.max_attempts, job.not_before - time.time()))
+        else:
+            print('--- ' + job.describe() + ': FAILED ---')
+
+    def on_worker_update(self, worker, line):
+        '''PortWorker callback: progress lines are shown in the port list, other lines go to the console'''
+        if line is None or dfu_core.PROGRESS_RE.search(line):
+            self.tasks.post(self.on_port_update, worker.port, worker.status, worker.progress, worker.rate)
+        else:
+            self.console.write('[' + worker.port + '] ' + line + '\n')
+
+    def station_flash(self, port):
+        '''Queue a flash of a board that was just plugged in, unless its port already has a job'''
+        problem = self.flash_request_problem()
+        if problem:
+            print('station mode: ' + problem)
+            return
+        if self.scheduler.is_busy(port) or any(job.port == port for job in self.pendingJobs):
+            print('station mode: ' + port + ' is already being flashed')
+            return
+        if time.time() - self.portsFinished.get(port, 0) < STATION_HOLDOFF_S:
+            print('station mode: ' + port + ' was just flashed, not flashing it again')
+            return
 
-        # Enable all button
-        self.eraseButton.Enable()
-        self.project_browseButton.Enable()
-        self.app_browseButton.Enable()
-        self.partition_browseButton.Enable()
-        self.spiffs_browseButton.Enable()
-        self.bootloader_browseButton.Enable()
-        self.flashButton.Enable()
+        # let the adapter finish enumerating before it is reset
+        self.submit_jobs(dfu_jobs.FLASH, [port], delay=STATION_SETTLE_S)
 
 
 def main():
@@ -596,10 +1052,20 @@ def main():
     app = wx.App()
     window = dfuTool(None, title='ESP Flasher Programming Tool - ' + VERSION)
     window.Show()
+    STARTUP.mark('frame')
+    window.tasks.post(window.on_startup_ready)
 
     app.MainLoop()
 
-    window.clean_options()
+    window.portWatcher.stop()
+    window.scheduler.stop()
+    for monitor in window.monitors:
+        monitor.stop()
+    window.tasks.shutdown()
+    # boards left in download mode by an erase go back to their app
+    window.jobRunner.close_all('hard_reset')
+    dfu_core.stats().flush()
+    window.console.close()
 
 if __name__ == '__main__':
     main()
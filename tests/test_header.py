@@ -0,0 +1,43 @@
+'''Image headers are read right whatever chip they are built for'''
+import os
+import sys
+import struct
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT]
+
+import dfu_header
+
+
+def esp8266_image(*segments):
+    '''ESP8266 image of [(load address, data)], no extended header'''
+    image = struct.pack('<BBBBI', 0xE9, len(segments), 2, 0x2F, 0x40100000)
+    checksum = 0xEF
+    for address, data in segments:
+        image += struct.pack('<II', address, len(data)) + data
+        for byte in data:
+            checksum ^= byte
+    image += b'\x00' * (15 - len(image) % 16) + bytes([checksum])
+    return image
+
+
+def test_esp8266_image_with_a_chip_id_of_zero():
+    # a 64 KB first segment puts 0x0000, the chip id of the ESP32, where the extended header would be
+    data = esp8266_image((0x40100000, os.urandom(0x10000)), (0x3FFE8000, os.urandom(100)))
+    assert data[12:14] == b'\x00\x00'
+    header = dfu_header.parse_header(data, 'app')
+    assert header.chip == 'esp8266'
+    assert header.chip_id is None
+    assert len(header.segments) == 2
+    assert header.length == len(data)
+
+
+def test_corrupt_esp8266_image_is_refused():
+    data = bytearray(esp8266_image((0x40100000, os.urandom(0x10000))))
+    data[100] ^= 1
+    try:
+        dfu_header.parse_header(bytes(data), 'app')
+    except ValueError:
+        pass
+    else:
+        assert False, 'corrupt image accepted'
@@ -0,0 +1,42 @@
+'''A board failing its self-test fails its job record, and is not flashed again'''
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+import esp_sim
+import dfu_core
+import dfu_jobs
+import dfu_metrics
+import dfu_monitor
+import dfu_project
+
+
+def test_self_test_timeout_fails_the_record(tmp_path, monkeypatch):
+    monkeypatch.setenv('APPDATA', str(tmp_path))
+    sim = esp_sim.SimulatedEsp(simulate_link=False).start()
+    try:
+        image = dfu_project.FirmwareImage('app', 'app.bin', os.urandom(64 * 1024))
+        job = dfu_metrics.JobRecord()
+        # the simulated board never logs anything, so the pass pattern never matches
+        monitor = {'duration': 0.5, 'pass_pattern': 'SELFTEST PASS'}
+        assert not dfu_core.flash_images(sim.port, '921600', 'esp32', [('0x10000', image)], 'no_reset', 'no_reset',
+                                         job=job, monitor=monitor)
+    finally:
+        sim.stop()
+
+    assert job.ok is False
+    assert job.self_test == dfu_monitor.TIMEOUT
+    assert job.stages[-1]['stage'] == 'monitor' and job.stages[-1]['failed']
+    assert job.as_dict()['self_test'] == dfu_monitor.TIMEOUT
+
+
+def test_failed_self_test_is_not_retried():
+    queue = dfu_jobs.JobQueue()
+    job = dfu_jobs.FlashJob(dfu_jobs.FLASH, 'COM3', 921600, 'esp32')
+    queue.submit(job)
+    assert queue.take(set())[0] is job
+    job.self_test = dfu_monitor.FAILED
+    queue.finish(job, False)
+    assert job.state == dfu_jobs.FAILED
@@ -0,0 +1,29 @@
+'''A write cut by a lost reply resumes from its checkpoint, on the simulated board of bench/esp_sim.py'''
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+import esp_sim
+import dfu_core
+import dfu_metrics
+import dfu_project
+
+
+def test_write_resumes_after_lost_reply(tmp_path, monkeypatch):
+    monkeypatch.setenv('APPDATA', str(tmp_path))
+    # the board writes the 5th compressed block, its reply never comes back
+    sim = esp_sim.SimulatedEsp(simulate_link=False, drop_replies={esp_sim.FLASH_DEFL_DATA: [5]}).start()
+    try:
+        image = dfu_project.FirmwareImage('spiffs', 'spiffs.bin', os.urandom(400 * 1024))
+        job = dfu_metrics.JobRecord()
+        assert dfu_core.flash_images(sim.port, '921600', 'esp32', [('0x10000', image)], 'no_reset', 'no_reset', job=job)
+    finally:
+        sim.stop()
+
+    assert bytes(sim.flash[0x10000:0x10000 + len(image.data)]) == image.data
+    writes = [stage for stage in job.stages if stage['stage'] == 'write']
+    assert [stage.get('failed', False) for stage in writes] == [True, False]
+    # the second write only sent what the board had not acknowledged
+    assert 0 < writes[1]['bytes'] < len(image.data)